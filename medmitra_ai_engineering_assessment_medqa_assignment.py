@@ -9,58 +9,117 @@ Original file is located at
 
 !pip install sentence-transformers
 
+import io
+import os
 import json
 import pandas as pd
 import re
 import numpy as np
 import nltk
+from multiprocessing import Pool
 from nltk.tokenize import word_tokenize, sent_tokenize
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import SentenceTransformer, CrossEncoder
 import faiss
 
 # Download necessary NLTK data
 nltk.download('punkt')
 
-# Load dataset (limit to the first 1000 entries for memory efficiency)
-def load_dataset(file_path, limit=1000):
-    data = []
-    with open(file_path, 'r') as f:
-        for idx, line in enumerate(f):
-            if idx >= limit:
+# Split the file into byte ranges that start on line boundaries (one range per worker)
+def shard_offsets(file_path, num_shards, start=0):
+    size = os.path.getsize(file_path)
+    bounds = [start]
+    with open(file_path, 'rb') as f:
+        for i in range(1, num_shards):
+            pos = start + (size - start) * i // num_shards
+            f.seek(max(pos - 1, 0))
+            f.readline()  # Move forward to the start of the next full line
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(s, e) for s, e in zip(bounds[:-1], bounds[1:]) if s < e]
+
+# Stream the JSONL file as fixed-size columnar batches, so memory stays flat however big the file is.
+# Every batch comes with the byte offset right after it, which can be passed back as `start` to resume.
+def iter_dataset_batches(file_path, batch_size=50000, start=0, end=None):
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while end is None or offset < end:
+            lines = []
+            while len(lines) < batch_size and (end is None or offset < end):
+                line = f.readline()
+                if not line:
+                    break
+                offset += len(line)
+                if line.strip():
+                    lines.append(line)
+            if not lines:
+                break
+            # pandas parses the whole block in one call instead of one json.loads per line
+            batch = pd.read_json(io.BytesIO(b''.join(lines)), lines=True, dtype=False, convert_dates=False)
+            yield batch, offset
+
+# Load one byte range of the file (runs inside a worker process)
+def _load_shard(args):
+    file_path, start, end, batch_size = args
+    frames = [batch for batch, _ in iter_dataset_batches(file_path, batch_size, start, end)]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+# Load dataset (optionally only the first `limit` entries, or split across `num_workers` processes)
+def load_dataset(file_path, limit=None, batch_size=50000, num_workers=1, start=0):
+    frames = []
+    if num_workers > 1 and limit is None:
+        shards = [(file_path, s, e, batch_size) for s, e in shard_offsets(file_path, num_workers, start)]
+        with Pool(num_workers) as pool:
+            frames = pool.map(_load_shard, shards)
+    else:
+        rows = 0
+        if limit is not None:
+            batch_size = min(batch_size, limit)
+        for batch, _ in iter_dataset_batches(file_path, batch_size, start):
+            if limit is not None:
+                batch = batch.iloc[:limit - rows]
+            frames.append(batch)
+            rows += len(batch)
+            if limit is not None and rows >= limit:
                 break
-            data.append(json.loads(line))
-    return pd.DataFrame(data)
+    frames = [frame for frame in frames if len(frame)]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
 df = load_dataset("/content/MED_QA.jsonl", limit=1000)
 
 """1. **Data Preparation**"""
 
+# Precompiled cleaning patterns, giving exactly the result of the original sequential passes: first
+# content inside square brackets is removed, then content inside parentheses and runs of special
+# characters and numbers in one scan (an opening parenthesis without a matching close is removed like any
+# other special character). Brackets must go first: with interleaved spans such as '(a[)b]' the order
+# decides what is left, and cached query keys and the indexed text depend on it.
+BRACKET_PATTERN = re.compile(r'\[.*?\]')
+CLEAN_TEXT_PATTERN = re.compile(r'\(.*?\)|[^a-zA-Z\s(]+|\(')
+
 # Text cleaning function
 def clean_text(text):
-    text = re.sub(r'\[.*?\]', '', text)  # Remove content inside square brackets
-    text = re.sub(r'\(.*?\)', '', text)  # Remove content inside parentheses
-    text = re.sub(r'[^a-zA-Z\s]', '', text)  # Remove special characters and numbers
-    text = text.lower()  # Convert to lowercase
-    text = re.sub(r'[^\w\s]', ' ', text)  # Remove any remaining non-word characters
-    return text
+    return CLEAN_TEXT_PATTERN.sub('', BRACKET_PATTERN.sub('', text)).lower()  # Convert to lowercase
+
+# Clean one chunk of texts (runs inside a worker process when num_workers > 1)
+def _clean_chunk(texts):
+    return [clean_text(text) for text in texts]
+
+# Clean a whole column in chunks, optionally across worker processes; a Series comes back with its index
+def clean_texts(texts, num_workers=1, chunk_size=10000):
+    values = list(texts)
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            cleaned_chunks = pool.map(_clean_chunk, chunks)
+    else:
+        cleaned_chunks = map(_clean_chunk, chunks)
+    cleaned = [text for chunk in cleaned_chunks for text in chunk]
+    return pd.Series(cleaned, index=texts.index, dtype=object) if isinstance(texts, pd.Series) else cleaned
 
 # Apply cleaning to questions and answers
-df['cleaned_question'] = df['question'].apply(clean_text)
-df['cleaned_answer'] = df['answer'].apply(clean_text)
-
-# Tokenization of questions and answers
-df['tokenized_question'] = df['cleaned_question'].apply(word_tokenize)
-df['tokenized_answer'] = df['cleaned_answer'].apply(word_tokenize)
-
-# Chunking text into smaller passages (with a max limit of 512 tokens)
-def chunk_text(text, max_chunk_size=512):
-    words = word_tokenize(text)
-    chunks = [' '.join(words[i:i+max_chunk_size]) for i in range(0, len(words), max_chunk_size)]
-    return chunks
-
-# Chunk both questions and answers
-df['chunked_question'] = df['cleaned_question'].apply(lambda x: chunk_text(x, max_chunk_size=512))
-df['chunked_answer'] = df['cleaned_answer'].apply(lambda x: chunk_text(x, max_chunk_size=512))
+df['cleaned_question'] = clean_texts(df['question'])
+df['cleaned_answer'] = clean_texts(df['answer'])
 
 # Fix the map_option_to_answer function
 def map_option_to_answer(row):
@@ -75,11 +134,169 @@ def map_option_to_answer(row):
 df['full_answer_text'] = df.apply(map_option_to_answer, axis=1)
 
 # Load pre-trained Sentence-BERT model for embeddings
-model = SentenceTransformer('all-MiniLM-L6-v2')
-
-# Generate embeddings for cleaned questions (concatenating chunked results)
-df['question_embeddings'] = df['cleaned_question'].apply(lambda x: model.encode(x))
-df['answer_embeddings'] = df['cleaned_answer'].apply(lambda x: model.encode(x))
+embedding_model_name = 'all-MiniLM-L6-v2'
+model = SentenceTransformer(embedding_model_name)
+
+import time
+
+# Encode texts in length-sorted batches straight into one preallocated float32 matrix
+# (similar lengths in a batch means little padding, and no per-row Python objects to copy later)
+def embed_texts(texts, encoder, batch_size=256, num_workers=1, verbose=True):
+    texts = list(texts)
+    embeddings = np.empty((len(texts), encoder.get_sentence_embedding_dimension()), dtype='float32')
+    order = np.argsort([len(text) for text in texts], kind='stable')
+    start_time = time.perf_counter()
+
+    if num_workers > 1:
+        # Multi-process CPU pool: each worker process encodes its own share of the sorted texts
+        pool = encoder.start_multi_process_pool(target_devices=['cpu'] * num_workers)
+        try:
+            embeddings[order] = encoder.encode_multi_process([texts[i] for i in order], pool, batch_size=batch_size)
+        finally:
+            encoder.stop_multi_process_pool(pool)
+    else:
+        for start in range(0, len(texts), batch_size):
+            batch_idx = order[start:start + batch_size]
+            embeddings[batch_idx] = encoder.encode([texts[i] for i in batch_idx], batch_size=batch_size, convert_to_numpy=True)
+
+    elapsed = time.perf_counter() - start_time
+    if verbose:
+        print(f"Embedded {len(texts)} texts in {elapsed:.1f}s ({len(texts) / max(elapsed, 1e-9):.0f} rows/sec)")
+    return embeddings
+
+import hashlib
+
+# Persistent embedding cache keyed by (model name, normalized text hash).
+# Vectors are appended to a raw float32 file and read back through a memory map,
+# so a rebuild only has to encode rows whose text is new or has changed.
+class EmbeddingCache:
+    KEY_SIZE = 16
+
+    def __init__(self, cache_dir, model_name, dim):
+        self.model_name = model_name
+        self.dim = dim
+        self.cache_dir = os.path.join(cache_dir, re.sub(r'[^\w.-]', '_', model_name))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.keys_path = os.path.join(self.cache_dir, 'keys.bin')
+        self.vectors_path = os.path.join(self.cache_dir, 'vectors.f32')
+        self._load()
+
+    def _load(self):
+        keys = b''
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'rb') as f:
+                keys = f.read()
+        num_vectors = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+        self.count = min(len(keys) // self.KEY_SIZE, num_vectors)  # Ignore a partially written tail
+        self.rows = {keys[i * self.KEY_SIZE:(i + 1) * self.KEY_SIZE]: i for i in range(self.count)}
+        self._map_vectors()
+
+    def _map_vectors(self):
+        if self.count:
+            self.vectors = np.memmap(self.vectors_path, dtype='float32', mode='r', shape=(self.count, self.dim))
+        else:
+            self.vectors = np.empty((0, self.dim), dtype='float32')
+
+    def key(self, text):
+        normalized = ' '.join(text.split())  # Whitespace differences should not cause a re-embed
+        return hashlib.blake2b(f"{self.model_name}\0{normalized}".encode('utf-8'), digest_size=self.KEY_SIZE).digest()
+
+    def add(self, keys, vectors):
+        # Drop any partially written tail, then write vectors before keys so a key never points past the data
+        for path, size in ((self.vectors_path, self.count * 4 * self.dim), (self.keys_path, self.count * self.KEY_SIZE)):
+            if os.path.exists(path):
+                os.truncate(path, size)
+        with open(self.vectors_path, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype='float32').tobytes())
+        with open(self.keys_path, 'ab') as f:
+            f.write(b''.join(keys))
+        # Extend the in-memory index instead of re-reading keys.bin, so growing the cache stays linear
+        for key in keys:
+            self.rows[key] = self.count
+            self.count += 1
+        self._map_vectors()
+
+# Embed texts through the cache: only texts that are not cached yet get encoded
+def embed_texts_cached(texts, encoder, cache, **kwargs):
+    texts = list(texts)
+    keys = [cache.key(text) for text in texts]
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cache.rows and key not in missing:
+            missing[key] = text
+    if missing:
+        cache.add(list(missing), embed_texts(list(missing.values()), encoder, **kwargs))
+    return cache.vectors[[cache.rows[key] for key in keys]]  # Fancy indexing copies into a regular float32 array
+
+embedding_cache = EmbeddingCache('./embedding_cache', embedding_model_name, model.get_sentence_embedding_dimension())
+
+# Generate embeddings for cleaned questions and answers (one row per DataFrame row)
+question_embeddings = embed_texts_cached(df['cleaned_question'], model, embedding_cache)
+answer_embeddings = embed_texts_cached(df['cleaned_answer'], model, embedding_cache)
+
+import itertools
+from functools import lru_cache
+
+# Chunk sizes are measured in tokens of the embedding model (MiniLM WordPiece), which is what limits its input
+embedding_tokenizer = model.tokenizer
+
+# Number of embedding-model tokens in one word, cached per distinct word
+@lru_cache(maxsize=1000000)
+def model_token_count(word):
+    return max(len(embedding_tokenizer.tokenize(word)), 1)
+
+# Tokenize a document once and cut the same tokens into overlapping windows: every window holds at most
+# max_chunk_tokens model tokens and starts about overlap_tokens before the end of the previous one.
+# Returns (word tokens, chunks), so the tokenization and the chunking share one word_tokenize call.
+def tokenize_and_chunk(text, max_chunk_tokens=256, overlap_tokens=32):
+    words = word_tokenize(text)
+    counts = [model_token_count(word) for word in words]
+    chunks = []
+    start = 0
+    while start < len(words):
+        end, size = start, 0
+        while end < len(words) and (size + counts[end] <= max_chunk_tokens or end == start):
+            size += counts[end]
+            end += 1
+        chunks.append(' '.join(words[start:end]))
+        if end == len(words):
+            break
+        # Step back from the window end to repeat up to overlap_tokens tokens (always moving forward)
+        next_start, overlap = end, 0
+        while next_start > start + 1 and overlap + counts[next_start - 1] <= overlap_tokens:
+            next_start -= 1
+            overlap += counts[next_start]
+        start = next_start
+    return words, chunks
+
+# Chunking text into smaller passages (with a max limit of 256 model tokens per chunk)
+def chunk_text(text, max_chunk_size=256, overlap=0):
+    return tokenize_and_chunk(text, max_chunk_tokens=max_chunk_size, overlap_tokens=overlap)[1]
+
+# Stream chunk records for the given text columns instead of adding tokenized_* / chunked_* list columns
+def iter_chunk_records(df, fields=('cleaned_question', 'cleaned_answer'), max_chunk_tokens=256, overlap_tokens=32):
+    for field in fields:
+        for row_id, text in zip(df.index, df[field]):
+            _, chunks = tokenize_and_chunk(text, max_chunk_tokens, overlap_tokens)
+            for chunk_number, chunk in enumerate(chunks):
+                yield {'row_id': row_id, 'field': field, 'chunk': chunk_number, 'text': chunk}
+
+# Embedding stage fed straight from a record stream: yields (records, float32 embeddings) batch by batch
+def embed_chunk_records(records, encoder, batch_size=1024, cache=None):
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        texts = [record['text'] for record in batch]
+        if cache is not None:
+            yield batch, embed_texts_cached(texts, encoder, cache, verbose=False)
+        else:
+            yield batch, embed_texts(texts, encoder, verbose=False)
+
+# Example: the first chunk records of the cleaned questions and answers
+for record in itertools.islice(iter_chunk_records(df), 3):
+    print(record)
 
 """2. **Retrieval System Implementation**
 
@@ -91,53 +308,841 @@ import faiss
 
 # Assume `df` contains preprocessed questions and answers, and we already generated embeddings for each
 
-# Create FAISS index using L2 (Euclidean distance) or you could switch to cosine similarity if needed
-def create_faiss_index(embeddings):
-    # Initialize FAISS index (L2 distance, alternative: faiss.IndexFlatIP for inner product)
-    index = faiss.IndexFlatL2(embeddings.shape[1])  # embeddings.shape[1] is the dimensionality of embeddings
+# Set the query-time knobs of an approximate index (ignored by index types that do not have them)
+def set_search_params(index, nprobe=None, ef_search=None):
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)  # The knobs live on the wrapped index
+    if nprobe is not None and hasattr(index, 'nprobe'):
+        index.nprobe = nprobe  # IVF: number of inverted lists visited per query
+    if ef_search is not None and hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = ef_search  # HNSW: size of the candidate list during graph search
+
+# Return float32 vectors ready for an index of the given metric ('cosine' vectors are L2-normalized
+# once here, so the index can use the plain inner-product kernels)
+def prepare_embeddings(embeddings, metric='l2'):
+    embeddings = np.array(embeddings, dtype='float32')  # Copy, so the caller's matrix is left untouched
+    if metric == 'cosine':
+        faiss.normalize_L2(embeddings)
+    elif metric != 'l2':
+        raise ValueError(f"Unknown metric: {metric}")
+    return embeddings
+
+# Create FAISS index using L2 (Euclidean distance) or cosine similarity (inner product on normalized vectors).
+# index_type: 'flat' (exact, brute force), or the approximate 'ivf_flat', 'ivf_pq' and 'hnsw' modes
+# whose query latency grows sublinearly with the corpus size.
+def create_faiss_index(embeddings, index_type='flat', metric='l2', **index_kwargs):
+    embeddings = prepare_embeddings(embeddings, metric)
+    index = new_faiss_index(embeddings.shape[1], index_type, metric, train_vectors=embeddings, **index_kwargs)
     index.add(embeddings)  # Add all the precomputed question embeddings
     return index
 
-# Convert the question embeddings to numpy array
-question_embeddings = np.array(df['question_embeddings'].tolist()).astype('float32')
+# Create an empty FAISS index of dimension d; IVF modes are trained on a sample of `train_vectors`
+# (already prepared for the metric), so vectors can then be added in as many batches as needed.
+# Indexes that are served memory-mapped should be IVF: faiss only memory-maps IVF inverted lists, so a flat
+# (or HNSW) index opened with IO_FLAG_MMAP is still read into private memory, one copy per worker process.
+def new_faiss_index(d, index_type='flat', metric='l2', train_vectors=None, nlist=None, pq_m=48, hnsw_m=32, train_size=100000, nprobe=8, ef_search=64):
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == 'cosine' else faiss.METRIC_L2
+    if index_type == 'flat':
+        index = faiss.IndexFlatIP(d) if metric == 'cosine' else faiss.IndexFlatL2(d)
+    elif index_type in ('ivf_flat', 'ivf_pq'):
+        sample_size = min(train_size, len(train_vectors))
+        nlist = min(nlist or int(4 * np.sqrt(len(train_vectors))), sample_size)  # Rule of thumb: ~4*sqrt(N) lists
+        quantizer = faiss.IndexFlatIP(d) if metric == 'cosine' else faiss.IndexFlatL2(d)
+        if index_type == 'ivf_flat':
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss_metric)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, 8, faiss_metric)  # pq_m sub-vectors of 8 bits each
+        # Train the coarse quantizer (and PQ codebooks) on a random sample rather than the full corpus
+        sample = np.random.default_rng(42).choice(len(train_vectors), sample_size, replace=False)
+        index.train(train_vectors[np.sort(sample)])
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(d, hnsw_m, faiss_metric)
+    else:
+        raise ValueError(f"Unknown index type: {index_type}")
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    return index
+
+# Recall@k and per-query latency of an approximate index against exact flat search,
+# swept over nprobe (IVF) or efSearch (HNSW) to pick an operating point
+def index_recall_report(index, embeddings, queries, k=10, metric='l2', nprobe_values=(1, 4, 8, 16, 64), ef_search_values=(16, 32, 64, 128, 256)):
+    queries = prepare_embeddings(queries, metric)
+    flat_index = create_faiss_index(embeddings, metric=metric)
+    _, true_indices = flat_index.search(queries, k)
+
+    if hasattr(index, 'nprobe'):
+        sweep, original = [{'nprobe': v} for v in nprobe_values], {'nprobe': index.nprobe}
+    elif hasattr(index, 'hnsw'):
+        sweep, original = [{'ef_search': v} for v in ef_search_values], {'ef_search': index.hnsw.efSearch}
+    else:
+        sweep, original = [{}], {}
+
+    report = []
+    for params in sweep:
+        set_search_params(index, **params)
+        latencies, hits = [], 0
+        for query, truth in zip(queries, true_indices):
+            start_time = time.perf_counter()
+            _, found = index.search(query[None, :], k)  # One query at a time, as the service searches
+            latencies.append(time.perf_counter() - start_time)
+            hits += len(set(found[0]) & set(truth))
+        latencies_ms = np.array(latencies) * 1000
+        report.append({
+            **params,
+            f'recall@{k}': hits / (k * len(queries)),
+            'p50_ms': np.percentile(latencies_ms, 50),
+            'p99_ms': np.percentile(latencies_ms, 99),
+        })
+    set_search_params(index, **original)
+    return pd.DataFrame(report)
+
+import mmap
+
+# Compact passage store: one contiguous UTF-8 blob plus an int64 offsets array
+# (passage i is blob[offsets[i]:offsets[i + 1]]). Passages can be added in batches.
+class PassageStoreWriter:
+    def __init__(self, path_prefix):
+        self.path_prefix = path_prefix
+        self.blob = open(path_prefix + '.bin', 'wb')
+        self.offsets = [0]
+
+    def add(self, passages):
+        for passage in passages:
+            data = passage.encode('utf-8')
+            self.blob.write(data)
+            self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self):
+        self.blob.close()
+        np.save(self.path_prefix + '.offsets.npy', np.array(self.offsets, dtype='int64'))
+
+def write_passage_store(passages, path_prefix):
+    writer = PassageStoreWriter(path_prefix)
+    writer.add(passages)
+    writer.close()
+
+# Read-only view over a passage store. Both files are memory-mapped, so opening it is instant
+# and every worker process shares the same page-cache copy.
+class PassageStore:
+    def __init__(self, path_prefix):
+        self.offsets = np.load(path_prefix + '.offsets.npy', mmap_mode='r')
+        self.blob = b''
+        if os.path.getsize(path_prefix + '.bin'):
+            with open(path_prefix + '.bin', 'rb') as f:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-# Create FAISS index and store embeddings
-index = create_faiss_index(question_embeddings)
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return self.blob[int(self.offsets[idx]):int(self.offsets[idx + 1])].decode('utf-8')
+
+# Offline build step: write the FAISS index and the passage store side by side in `out_dir`
+# (IVF by default, so the served mmap is shared; see new_faiss_index)
+def build_retrieval_artifacts(passages, embeddings, out_dir, index_type='ivf_flat', **index_kwargs):
+    os.makedirs(out_dir, exist_ok=True)
+    index = create_faiss_index(embeddings, index_type=index_type, **index_kwargs)
+    faiss.write_index(index, os.path.join(out_dir, 'faiss_index.index'))
+    write_passage_store(passages, os.path.join(out_dir, 'passages'))
+    return index
+
+# Service startup: memory-map the prebuilt index and passage store instead of re-encoding the corpus
+def load_retrieval_artifacts(out_dir):
+    index = faiss.read_index(os.path.join(out_dir, 'faiss_index.index'), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    return index, PassageStore(os.path.join(out_dir, 'passages'))
+
+# Create FAISS index and store embeddings ('cosine' scores are similarities, higher = more relevant)
+index_metric = 'cosine'
+index = create_faiss_index(question_embeddings, metric=index_metric)
+
+# Compare the approximate index modes with the exact flat index before switching `index` over
+sample_queries = question_embeddings[:200]
+for index_type in ['ivf_flat', 'ivf_pq', 'hnsw']:
+    print(index_type)
+    approximate_index = create_faiss_index(question_embeddings, index_type=index_type, metric=index_metric)
+    print(index_recall_report(approximate_index, question_embeddings, sample_queries, metric=index_metric))
+
+# Text columns returned for each retrieved row. Each one is written to a passage store (row i at
+# position i), so results are read straight from the mmap instead of slicing the DataFrame.
+RESULT_COLUMNS = ('cleaned_question', 'cleaned_answer', 'full_answer_text')
+
+def build_row_stores(df, out_dir, columns=RESULT_COLUMNS):
+    os.makedirs(out_dir, exist_ok=True)
+    for column in columns:
+        write_passage_store(df[column].astype(str), os.path.join(out_dir, column))
+    return load_row_stores(out_dir, columns)
+
+def load_row_stores(out_dir, columns=RESULT_COLUMNS):
+    return {column: PassageStore(os.path.join(out_dir, column)) for column in columns}
+
+row_stores = build_row_stores(df, "row_store")
+
+# Lightweight search result: parallel arrays of row positions and scores (best first, as FAISS
+# returns them) plus the row stores. Text is only decoded for the rows that are actually read.
+class RetrievalResults:
+    __slots__ = ('ids', 'scores', 'stores')
+
+    def __init__(self, ids, scores, stores):
+        if len(ids) and ids[-1] < 0:  # FAISS pads the tail with -1 when it finds fewer than k rows
+            found = int((ids >= 0).sum())
+            ids, scores = ids[:found], scores[:found]
+        self.ids = ids
+        self.scores = scores
+        self.stores = stores
+
+    def __len__(self):
+        return len(self.ids)
+
+    def text(self, column, i):
+        return self.stores[column][int(self.ids[i])]
+
+    def __getitem__(self, i):
+        row = {'row_id': int(self.ids[i])}
+        row.update((column, store[row['row_id']]) for column, store in self.stores.items())
+        row['relevance_score'] = float(self.scores[i])
+        return row
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    # DataFrame view, for display and analysis only
+    def to_frame(self):
+        return pd.DataFrame(list(self)).set_index('row_id')
+
+    def __repr__(self):
+        return repr(self.to_frame())
+
+# Index array covering the ranges [starts[i], ends[i]) back to back
+def concat_ranges(starts, ends):
+    lengths = ends - starts
+    return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+# Offline build of a BM25 inverted index over cleaned texts (whitespace tokens, as clean_text leaves
+# only lowercase words). Each term's postings are cut into blocks of `block_size` documents:
+# - doc IDs are delta-encoded within the term, and each block stores its deltas at the narrowest
+#   byte width that fits them (1, 2 or 4 bytes), so a block decodes with a plain numpy view,
+# - term frequencies are stored as one byte each (BM25 saturates long before 255),
+# - every block keeps its last doc ID, so a search can skip straight to the blocks it needs.
+# Each term also stores its highest BM25 score, the upper bound used by MaxScore pruning.
+def build_bm25_index(texts, out_dir, k1=1.2, b=0.75, block_size=128):
+    os.makedirs(out_dir, exist_ok=True)
+    vocab = {}
+    term_ids, doc_lengths = [], []
+    for text in texts:
+        words = text.split()
+        doc_lengths.append(len(words))
+        term_ids.extend(vocab.setdefault(word, len(vocab)) for word in words)
+    doc_lengths = np.array(doc_lengths, dtype='int64')
+    num_docs = len(doc_lengths)
+
+    # Postings sorted by (term, doc) with their term frequencies
+    keys, tfs = np.unique(np.array(term_ids, dtype='int64') * num_docs + np.repeat(np.arange(num_docs), doc_lengths), return_counts=True)
+    terms, docs = np.divmod(keys, num_docs)
+    doc_counts = np.bincount(terms, minlength=len(vocab))
+    term_starts = np.concatenate([[0], np.cumsum(doc_counts)])
+
+    avg_length = max(doc_lengths.mean(), 1) if num_docs else 1
+    doc_norms = (k1 * (1 - b + b * doc_lengths / avg_length)).astype('float32')
+    idf = np.log(1 + (num_docs - doc_counts + 0.5) / (doc_counts + 0.5)).astype('float32')
+    tfs = np.minimum(tfs, 255).astype('uint8')
+    impacts = idf[terms] * tfs * (k1 + 1) / (tfs + doc_norms[docs])
+    max_scores = np.maximum.reduceat(impacts, term_starts[:-1]).astype('float32') if len(vocab) else np.empty(0, dtype='float32')
+
+    rank_in_term = np.arange(len(docs)) - np.repeat(term_starts[:-1], doc_counts)
+    block_starts = np.flatnonzero(rank_in_term % block_size == 0)
+    posting_offsets = np.concatenate([block_starts, [len(docs)]])
+    deltas = np.diff(docs, prepend=0)
+    deltas[term_starts[:-1][doc_counts > 0]] = docs[term_starts[:-1][doc_counts > 0]]
+    block_counts = np.diff(posting_offsets)
+    block_max = np.maximum.reduceat(deltas, block_starts) if len(deltas) else np.empty(0, dtype='int64')
+    block_widths = np.select([block_max < 2 ** 8, block_max < 2 ** 16], [1, 2], 4).astype('uint8')
+    byte_offsets = np.concatenate([[0], np.cumsum(block_counts * block_widths)])
+    postings = np.empty(byte_offsets[-1], dtype='uint8')
+    for width in (1, 2, 4):
+        selected = block_widths == width
+        data = deltas[np.repeat(selected, block_counts)].astype('<u%d' % width).view('uint8')
+        postings[concat_ranges(byte_offsets[:-1][selected], byte_offsets[1:][selected])] = data
+
+    np.save(os.path.join(out_dir, 'postings.npy'), postings)
+    np.save(os.path.join(out_dir, 'tfs.npy'), tfs)
+    np.save(os.path.join(out_dir, 'block_last_doc.npy'), docs[posting_offsets[1:] - 1])
+    np.save(os.path.join(out_dir, 'block_posting_offsets.npy'), posting_offsets)
+    np.save(os.path.join(out_dir, 'block_byte_offsets.npy'), byte_offsets)
+    np.save(os.path.join(out_dir, 'block_widths.npy'), block_widths)
+    np.save(os.path.join(out_dir, 'term_blocks.npy'), np.concatenate([[0], np.cumsum((doc_counts + block_size - 1) // block_size)]))
+    np.save(os.path.join(out_dir, 'idf.npy'), idf)
+    np.save(os.path.join(out_dir, 'max_scores.npy'), max_scores)
+    np.save(os.path.join(out_dir, 'doc_norms.npy'), doc_norms)
+    with open(os.path.join(out_dir, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'k1': k1, 'b': b, 'num_docs': num_docs}, f)
+    return BM25Index(out_dir)
+
+# Memory-mapped BM25 index. search() scores term at a time with MaxScore pruning: query terms are
+# visited from the highest score bound down, and once the bounds of the terms left cannot lift an
+# unseen document into the top k, only the current candidates are scored, decoding just the
+# posting blocks that can contain them.
+class BM25Index:
+    ARRAYS = ('postings', 'tfs', 'block_last_doc', 'block_posting_offsets', 'block_byte_offsets', 'block_widths', 'term_blocks', 'idf', 'max_scores', 'doc_norms')
+
+    def __init__(self, out_dir):
+        for name in self.ARRAYS:
+            # Plain ndarray views over the mapped files (slicing a np.memmap subclass is much slower)
+            setattr(self, name, np.asarray(np.load(os.path.join(out_dir, name + '.npy'), mmap_mode='r')))
+        with open(os.path.join(out_dir, 'vocab.json')) as f:
+            self.vocab = json.load(f)
+        with open(os.path.join(out_dir, 'meta.json')) as f:
+            self.k1 = json.load(f)['k1']
+
+    # Doc IDs and BM25 scores of one term, for all of its blocks or only the given ones
+    def _postings(self, term, blocks=None):
+        first, last = int(self.term_blocks[term]), int(self.term_blocks[term + 1])
+        blocks = np.arange(first, last) if blocks is None else blocks + first
+        counts = self.block_posting_offsets[blocks + 1] - self.block_posting_offsets[blocks]
+        heads = np.cumsum(counts) - counts
+        widths = self.block_widths[blocks]
+        contiguous = blocks[-1] - blocks[0] == len(blocks) - 1
+        if contiguous and (widths == widths[0]).all():
+            data = self.postings[self.block_byte_offsets[blocks[0]]:self.block_byte_offsets[blocks[-1] + 1]]
+            deltas = data.view('<u%d' % widths[0]).astype('int64')
+        else:
+            deltas = np.empty(counts.sum(), dtype='int64')
+            for width in np.unique(widths):
+                selected = widths == width
+                data = self.postings[concat_ranges(self.block_byte_offsets[blocks[selected]], self.block_byte_offsets[blocks[selected] + 1])]
+                deltas[concat_ranges(heads[selected], heads[selected] + counts[selected])] = data.view('<u%d' % width)
+        if contiguous:
+            tfs = self.tfs[self.block_posting_offsets[blocks[0]]:self.block_posting_offsets[blocks[-1] + 1]]
+        else:
+            tfs = self.tfs[concat_ranges(self.block_posting_offsets[blocks], self.block_posting_offsets[blocks + 1])]
+        # Prefix sums restart at every block, from the last doc ID of the block before it
+        sums = np.cumsum(deltas)
+        bases = np.where(blocks > first, self.block_last_doc[blocks - 1], 0)
+        docs = sums + np.repeat(bases - (sums[heads] - deltas[heads]), counts)
+        tfs = np.asarray(tfs, dtype='float32')
+        return docs, self.idf[term] * tfs * (self.k1 + 1) / (tfs + self.doc_norms[docs])
+
+    # Top-k documents for a cleaned query: (doc IDs, BM25 scores), best first. Scores accumulate in a
+    # dense per-query array (allocated lazily by the OS, so only touched pages cost anything).
+    def search(self, query, k=10):
+        terms = sorted({self.vocab[word] for word in query.split() if word in self.vocab}, key=lambda term: -self.max_scores[term])
+        scores = np.zeros(len(self.doc_norms), dtype='float32')
+        # remaining[i]: the most that terms i, i + 1, ... can still add to any document's score
+        remaining = np.append(np.cumsum([self.max_scores[term] for term in terms][::-1])[::-1], 0)
+        threshold = 0
+        touched, candidates = [], None
+        for i, term in enumerate(terms):
+            if candidates is None and remaining[i] < threshold:
+                # No unseen document can reach the top k any more: only score the ones that still can
+                touched = np.concatenate(touched)
+                candidates = np.unique(touched) if len(touched) < len(scores) // 16 else np.flatnonzero(scores)
+            if candidates is None:
+                docs, term_scores = self._postings(term)
+                scores[docs] += term_scores  # A term lists each document once
+                touched.append(docs)
+                # The k-th best score among this term's documents is a lower bound for the final k-th best
+                if len(docs) >= k:
+                    threshold = max(threshold, np.partition(scores[docs], -k)[-k])
+                continue
+            candidates = candidates[scores[candidates] + remaining[i] >= threshold]
+            block_last_doc = self.block_last_doc[self.term_blocks[term]:self.term_blocks[term + 1]]
+            blocks = np.unique(np.minimum(np.searchsorted(block_last_doc, candidates), len(block_last_doc) - 1))
+            docs, term_scores = self._postings(term, blocks)
+            positions = np.minimum(np.searchsorted(candidates, docs), len(candidates) - 1)
+            found = candidates[positions] == docs
+            scores[docs[found]] += term_scores[found]
+            threshold = max(threshold, np.partition(scores[candidates], -k)[-k])
+        if candidates is None:
+            touched = np.concatenate(touched) if touched else np.empty(0, dtype='int64')
+            candidates = np.unique(touched) if len(touched) < len(scores) // 16 else np.flatnonzero(scores)
+        candidate_scores = scores[candidates]
+        top = np.argsort(-candidate_scores)[:k] if len(candidates) <= k else np.argpartition(-candidate_scores, k)[:k]
+        top = top[np.argsort(-candidate_scores[top], kind='stable')]
+        return candidates[top], candidate_scores[top]
+
+bm25_index = build_bm25_index(df['cleaned_question'], "bm25_index")
 
 # Preprocessing function for user queries (reuse the previous text cleaning)
 def preprocess_query(query):
     cleaned_query = clean_text(query)
     return cleaned_query
 
+# Batched query encoding: clean all queries and embed them in a single forward pass
+# (float32 for FAISS; a cosine index needs the queries normalized like the stored vectors)
+def encode_queries(queries):
+    cleaned_queries = [preprocess_query(query) for query in queries]
+    query_embeddings = model.encode(cleaned_queries, batch_size=max(len(cleaned_queries), 1), normalize_embeddings=(index_metric == 'cosine'))
+    return np.asarray(query_embeddings, dtype='float32')
+
 # Generate embedding for the query using the pre-trained model
 def encode_query(query):
-    cleaned_query = preprocess_query(query)
-    query_embedding = model.encode(cleaned_query).astype('float32')  # Convert to float32 for FAISS
-    return query_embedding
-
-# Retrieval function: Find top-N most relevant passages based on query
-def retrieve_top_n(query_embedding, k=5):
-    distances, indices = index.search(np.array([query_embedding]), k=k)  # Search FAISS index
-    results = df.iloc[indices[0]]  # Get corresponding rows from the dataframe
-    return results, distances[0]  # Return results and their distances/scores
-
-# Rank the retrieved results based on relevance scores (lower distance = more relevant)
-def rank_results(results, distances):
-    # Create a DataFrame to store results and their corresponding distances (i.e., relevance score)
-    ranked_results = results.copy()
-    ranked_results['relevance_score'] = distances  # Lower scores are better for L2 distance
-    ranked_results = ranked_results.sort_values(by='relevance_score', ascending=True)  # Sort by relevance
-    return ranked_results[['cleaned_question', 'cleaned_answer', 'full_answer_text', 'relevance_score']]
-
-# Example query process and ranking
+    return encode_queries([query])[0]
+
+# Batched retrieval: search the whole (num_queries, dim) query matrix with one FAISS call.
+# Returns (num_queries, k) arrays of row indices and distances/similarities.
+def retrieve_top_n_batch(query_embeddings, k=5):
+    distances, indices = index.search(np.ascontiguousarray(query_embeddings, dtype='float32'), k)
+    return indices, distances
+
+# Min-max scale scores to [0, 1] (all ones when they are equal)
+def normalize_scores(scores):
+    spread = scores.max() - scores.min() if len(scores) else 0
+    return (scores - scores.min()) / spread if spread > 0 else np.ones(len(scores), dtype='float32')
+
+# Fuse dense (FAISS) and sparse (BM25) hits: each side's scores are min-max normalized and combined as
+# alpha * dense + (1 - alpha) * sparse. A row missing from one side gets nothing from it.
+def fuse_scores(dense_ids, dense_scores, sparse_ids, sparse_scores, alpha=0.5):
+    found = dense_ids >= 0
+    dense_ids, dense_scores = dense_ids[found], dense_scores[found]
+    if index_metric == 'l2':
+        dense_scores = -dense_scores  # Lower L2 distance = more relevant
+    ids = np.union1d(dense_ids, sparse_ids)
+    fused = np.zeros(len(ids), dtype='float32')
+    fused[np.searchsorted(ids, dense_ids)] += alpha * normalize_scores(dense_scores)
+    fused[np.searchsorted(ids, sparse_ids)] += (1 - alpha) * normalize_scores(sparse_scores)
+    order = np.argsort(-fused, kind='stable')
+    return ids[order], fused[order]
+
+# Retrieval function: Find top-N most relevant passages based on query. With the query text, the
+# dense and BM25 candidates (candidate_factor * k from each) are fused into one hybrid ranking.
+def retrieve_top_n(query_embedding, k=5, query=None, alpha=0.5, candidate_factor=4):
+    if query is None:
+        indices, distances = retrieve_top_n_batch(query_embedding[None, :], k=k)  # Search FAISS index
+        results = RetrievalResults(indices[0], distances[0], row_stores)  # Row positions and scores, no DataFrame
+        return results, results.scores  # Return results and their distances (L2) or similarities (cosine)
+    indices, distances = retrieve_top_n_batch(query_embedding[None, :], k=candidate_factor * k)
+    sparse_ids, sparse_scores = bm25_index.search(preprocess_query(query), k=candidate_factor * k)
+    ids, fused = fuse_scores(indices[0], distances[0], sparse_ids, sparse_scores, alpha)
+    results = RetrievalResults(ids[:k], fused[:k], row_stores)
+    return results, results.scores  # Fused scores: higher = more relevant
+
+# Second retrieval stage: a small cross-encoder reads each (query, passage) pair jointly, which ranks
+# far better than embedding distance, so retrieval can go wide cheaply and the generator only sees
+# the few best passages. Pairs are scored in batches; with `budget_ms` set, scoring stops before a
+# batch that would overrun the budget, and unscored candidates keep their retrieval order behind
+# the scored ones.
+class Reranker:
+    def __init__(self, model_name='cross-encoder/ms-marco-MiniLM-L-6-v2', batch_size=32, max_length=256):
+        self.model = CrossEncoder(model_name, max_length=max_length, device='cpu')
+        self.batch_size = batch_size
+
+    # Rerank the candidates of several queries together: candidate_lists[i] holds the passages retrieved
+    # for queries[i], best first. Returns, per query, the top n as (candidate position, score) pairs.
+    def rerank_batch(self, queries, candidate_lists, n=5, budget_ms=None):
+        start = time.perf_counter()
+        # Interleave the queries by rank, so an early stop trims every query's tail instead of whole queries
+        pairs = sorted((rank, i) for i, candidates in enumerate(candidate_lists) for rank in range(len(candidates)))
+        scores = [np.full(len(candidates), -np.inf, dtype='float32') for candidates in candidate_lists]
+        batch_time = 0
+        for batch_start in range(0, len(pairs), self.batch_size):
+            if budget_ms is not None and (time.perf_counter() - start + batch_time) * 1000 > budget_ms:
+                break
+            batch = pairs[batch_start:batch_start + self.batch_size]
+            batch_timer = time.perf_counter()
+            batch_scores = self.model.predict([(queries[i], candidate_lists[i][rank]) for rank, i in batch], batch_size=self.batch_size, show_progress_bar=False)
+            batch_time = time.perf_counter() - batch_timer
+            for (rank, i), score in zip(batch, batch_scores):
+                scores[i][rank] = score
+        ranked = []
+        for query_scores in scores:
+            order = np.argsort(-query_scores, kind='stable')[:n]  # Stable: unscored candidates stay in retrieval order
+            ranked.append([(int(position), float(query_scores[position])) for position in order])
+        return ranked
+
+    def rerank(self, query, candidates, n=5, budget_ms=None):
+        return self.rerank_batch([query], [candidates], n, budget_ms)[0]
+
+reranker = Reranker()
+
+# Rank the retrieved results based on relevance scores (lower distance / higher similarity = more relevant).
+# FAISS and the hybrid fusion already return hits best first, so without a query the results are used as
+# they are; with the query text they are reranked by the cross-encoder and cut to the top n.
+def rank_results(results, distances, query=None, n=None, budget_ms=None):
+    if query is None:
+        return results
+    passages = [results.text('cleaned_question', i) + ' ' + results.text('full_answer_text', i) for i in range(len(results))]
+    ranked = reranker.rerank(query, passages, n=n or len(results), budget_ms=budget_ms)
+    positions = np.array([position for position, _ in ranked], dtype='int64')
+    return RetrievalResults(results.ids[positions], np.array([score for _, score in ranked], dtype='float32'), results.stores)
+
+# Example query process and ranking: retrieve 50 candidates, keep the 5 the cross-encoder ranks best
 user_query = "What is the treatment for diabetes?"
 query_embedding = encode_query(user_query)
-retrieved_results, distances = retrieve_top_n(query_embedding, k=5)
-ranked_results = rank_results(retrieved_results, distances)
+retrieved_results, distances = retrieve_top_n(query_embedding, k=50, query=user_query)
+ranked_results = rank_results(retrieved_results, distances, query=user_query, n=5, budget_ms=100)
 
 # Display ranked results
 print(ranked_results)
 
+# Several queries at once: one encoder pass and one FAISS search for the whole batch
+batch_queries = ["What is the treatment for diabetes?", "What causes hypertension?"]
+batch_indices, batch_distances = retrieve_top_n_batch(encode_queries(batch_queries), k=5)
+for query, row_indices, row_distances in zip(batch_queries, batch_indices, batch_distances):
+    print(query)
+    print(RetrievalResults(row_indices, row_distances, row_stores))
+
+"""**Passage-level corpus index**"""
+
+# Fields whose chunks become passages; a passage's field is stored as its position in this tuple
+PASSAGE_FIELDS = ('cleaned_question', 'cleaned_answer', 'options')
+
+# Passage records for the corpus index: chunked questions, answers and every answer option,
+# each tagged with its parent document (the DataFrame row id)
+def iter_passage_records(df, max_chunk_tokens=256, overlap_tokens=32):
+    yield from iter_chunk_records(df, PASSAGE_FIELDS[:2], max_chunk_tokens, overlap_tokens)
+    for row_id, options in zip(df.index, df['options']):
+        for option_text in options.values():
+            for chunk_number, chunk in enumerate(chunk_text(clean_text(option_text), max_chunk_tokens, overlap_tokens)):
+                yield {'row_id': row_id, 'field': 'options', 'chunk': chunk_number, 'text': chunk}
+
+# Build the passage index in `out_dir`. Passage IDs are assigned in order and never reused: passage i is
+# entry i of the passage store and of the parent-document / field arrays, and FAISS returns it as ID i
+# (through an IndexIDMap2). Records are embedded and added batch by batch, so the corpus never has to
+# fit in memory at once; IVF modes are trained on the first batch (IVF by default; see new_faiss_index).
+def build_passage_index(df, encoder, out_dir, metric='cosine', index_type='ivf_flat', batch_size=50000, cache=None, **index_kwargs):
+    os.makedirs(out_dir, exist_ok=True)
+    store = PassageStoreWriter(os.path.join(out_dir, 'passages'))
+    index, parents, field_codes = None, [], []
+    for records, embeddings in embed_chunk_records(iter_passage_records(df), encoder, batch_size, cache):
+        embeddings = prepare_embeddings(embeddings, metric)
+        if index is None:
+            index = faiss.IndexIDMap2(new_faiss_index(embeddings.shape[1], index_type, metric, train_vectors=embeddings, **index_kwargs))
+        first_id = len(parents)
+        index.add_with_ids(embeddings, np.arange(first_id, first_id + len(records), dtype='int64'))
+        store.add(record['text'] for record in records)
+        parents.extend(record['row_id'] for record in records)
+        field_codes.extend(PASSAGE_FIELDS.index(record['field']) for record in records)
+    store.close()
+    if index is None:
+        raise ValueError("No passages to index")
+
+    faiss.write_index(index, os.path.join(out_dir, 'faiss_index.index'))
+    np.save(os.path.join(out_dir, 'passage_parents.npy'), np.array(parents, dtype='int64'))
+    np.save(os.path.join(out_dir, 'passage_fields.npy'), np.array(field_codes, dtype='int8'))
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'metric': metric, 'index_type': index_type}, f)
+    return index
+
+# Point-in-time view of the passage metadata. A search reads one view from start to finish, so a
+# concurrent update or compaction never mixes old and new artifacts within one result.
+class PassageView:
+    def __init__(self, store, parents, field_codes, added=None, tombstones=frozenset()):
+        self.store = store
+        self.parents = parents
+        self.field_codes = field_codes
+        self.added = added or {}  # passage_id -> (doc_id, field code, text) for passages not compacted yet
+        self.tombstones = tombstones
+
+    # Parent document of a passage (-1 once the passage has been deleted), its field and its text
+    def parent(self, passage_id):
+        if passage_id in self.tombstones:
+            return -1
+        if passage_id in self.added:
+            return self.added[passage_id][0]
+        return int(self.parents[passage_id])
+
+    def field(self, passage_id):
+        if passage_id in self.added:
+            return PASSAGE_FIELDS[self.added[passage_id][1]]
+        return PASSAGE_FIELDS[self.field_codes[passage_id]]
+
+    def text(self, passage_id):
+        if passage_id in self.added:
+            return self.added[passage_id][2]
+        return self.store[passage_id]
+
+# Memory-mapped passage index with per-document de-duplication of the hits
+class PassageIndex:
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        with open(os.path.join(out_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.metric = meta['metric']
+        self.index_type = meta['index_type']
+        self._open()
+
+    def _open(self):
+        self.index = faiss.read_index(os.path.join(self.out_dir, 'faiss_index.index'), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        self.view = PassageView(
+            PassageStore(os.path.join(self.out_dir, 'passages')),
+            np.load(os.path.join(self.out_dir, 'passage_parents.npy'), mmap_mode='r'),
+            np.load(os.path.join(self.out_dir, 'passage_fields.npy'), mmap_mode='r'))
+
+    # Best fetch_k candidates per query from FAISS (scores, passage IDs) and the view to read them with
+    def _candidates(self, queries, fetch_k):
+        scores, ids = self.index.search(queries, max(min(fetch_k, self.index.ntotal), 1))
+        return scores, ids, self.view
+
+    # Top-k passages per query, keeping only the best passage of each parent document and dropping
+    # passages whose text was already returned. fetch_k candidates are read from FAISS to make up for that.
+    def search(self, query_embeddings, k=5, fetch_k=None):
+        queries = prepare_embeddings(np.atleast_2d(query_embeddings), self.metric)
+        scores, ids, view = self._candidates(queries, fetch_k or 4 * k)
+        results = []
+        for row_scores, row_ids in zip(scores, ids):
+            hits, seen_docs, seen_texts = [], set(), set()
+            for score, passage_id in zip(row_scores, row_ids):
+                if passage_id < 0:
+                    break  # FAISS pads missing hits with -1
+                doc_id = view.parent(passage_id)
+                if doc_id < 0 or doc_id in seen_docs:
+                    continue
+                text = view.text(passage_id)
+                if text in seen_texts:
+                    continue
+                seen_docs.add(doc_id)
+                seen_texts.add(text)
+                hits.append({
+                    'passage_id': int(passage_id),
+                    'doc_id': doc_id,
+                    'field': view.field(passage_id),
+                    'score': float(score),
+                    'text': text
+                })
+                if len(hits) == k:
+                    break
+            results.append(hits)
+        return results
+
+def load_passage_index(out_dir):
+    return PassageIndex(out_dir)
+
+# Build the passage index over the dataset (reusing cached embeddings) and query it
+passage_index_dir = "passage_index"
+build_passage_index(df, model, passage_index_dir, metric='cosine', cache=embedding_cache)
+passage_index = load_passage_index(passage_index_dir)
+for hit in passage_index.search(model.encode(preprocess_query("What is the treatment for diabetes?")), k=5)[0]:
+    print(hit)
+
+import base64
+import fcntl
+import threading
+
+# Passage index that takes new and deleted documents without a rebuild or re-embedding the corpus.
+# Every change is first appended (and fsynced) to a write-ahead log, wal.jsonl, which carries the new
+# passage vectors. It is then applied in memory: the base index stays a shared read-only mmap, new
+# passages go into a small in-memory delta that search merges in, and deleted ones become tombstones that
+# search skips. compact() folds the changes into new on-disk artifacts; start_compaction() runs it
+# periodically on a background thread.
+# Single process only: passage IDs, the delta and the WAL belong to the process that opened the index
+# (any number of threads may use it). A second process opening the same directory gets a RuntimeError;
+# other serving processes can open it read-only with PassageIndex and see the changes once compacted
+# and reopened.
+class MutablePassageIndex(PassageIndex):
+    def __init__(self, out_dir, encoder):
+        self.writer_lock = open(os.path.join(out_dir, 'writer.lock'), 'w')
+        try:
+            fcntl.flock(self.writer_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.writer_lock.close()
+            raise RuntimeError(f"{out_dir} is already open for writing in another process")
+        super().__init__(out_dir)
+        self.encoder = encoder
+        self.wal_path = os.path.join(out_dir, 'wal.jsonl')
+        # Guards the references below; they are replaced, never changed in place, so a search
+        # only holds the lock to read them and runs FAISS without it
+        self.lock = threading.Lock()
+        self.compaction_lock = threading.Lock()
+        self.added = {}
+        self.tombstones = frozenset()
+        self.delta_ids = np.empty(0, dtype='int64')
+        self.delta_vectors = np.empty((0, self.index.d), dtype='float32')
+        self.next_id = len(self.view.parents)
+        self._stop = threading.Event()
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path) as f:
+                self._apply([json.loads(line) for line in f if line.strip()])
+
+    def _log(self, ops):
+        with open(self.wal_path, 'a') as f:
+            for op in ops:
+                f.write(json.dumps(op) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Apply logged operations copy-on-write (called with the lock held, or before the index is shared)
+    def _apply(self, ops):
+        base_size = len(self.view.parents)
+        added, tombstones = dict(self.added), set(self.tombstones)
+        ids, vectors = [], []
+        for op in ops:
+            if op['op'] == 'add':
+                passage_id = op['passage_id']
+                if passage_id < base_size:
+                    continue  # Already folded into the base artifacts by an interrupted compaction
+                ids.append(passage_id)
+                vectors.append(np.frombuffer(base64.b64decode(op['vector']), dtype='float32'))
+                added[passage_id] = (op['doc_id'], op['field'], op['text'])
+                self.next_id = max(self.next_id, passage_id + 1)
+            elif op['op'] == 'delete':
+                tombstones.update(op['passage_ids'])
+        if ids:
+            self.delta_ids = np.concatenate([self.delta_ids, np.array(ids, dtype='int64')])
+            self.delta_vectors = np.concatenate([self.delta_vectors, np.stack(vectors)])
+        self.added = added
+        self.tombstones = frozenset(tombstones)
+
+    def _candidates(self, queries, fetch_k):
+        with self.lock:
+            index, view = self.index, self.view
+            added, tombstones = self.added, self.tombstones
+            delta_ids, delta_vectors = self.delta_ids, self.delta_vectors
+        view = PassageView(view.store, view.parents, view.field_codes, added, tombstones)
+        # Read extra candidates so tombstoned hits do not leave the result short
+        fetch_k += min(len(tombstones), 1000)
+        scores, ids = index.search(queries, max(min(fetch_k, index.ntotal), 1))
+        if len(delta_ids):
+            # Exact scores against the not yet compacted passages, merged into the FAISS ranking
+            if self.metric == 'cosine':
+                delta_scores = queries @ delta_vectors.T
+            else:
+                delta_scores = (queries ** 2).sum(axis=1)[:, None] + (delta_vectors ** 2).sum(axis=1)[None, :] - 2 * queries @ delta_vectors.T
+            scores = np.hstack([scores, delta_scores])
+            ids = np.hstack([ids, np.broadcast_to(delta_ids, delta_scores.shape)])
+            order = np.argsort(-scores if self.metric == 'cosine' else scores, axis=1, kind='stable')[:, :fetch_k]
+            scores, ids = np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+        return scores, ids, view
+
+    # Chunk, embed and add one new document; its passages are searchable as soon as this returns
+    def add_document(self, doc_id, question, answer='', options=None):
+        frame = pd.DataFrame([{'cleaned_question': clean_text(question), 'cleaned_answer': clean_text(answer), 'options': options or {}}], index=[doc_id])
+        records = list(iter_passage_records(frame))
+        if not records:
+            return []
+        embeddings = prepare_embeddings(embed_texts([record['text'] for record in records], self.encoder, verbose=False), self.metric)
+        with self.lock:
+            ops = []
+            for passage_id, record, vector in zip(range(self.next_id, self.next_id + len(records)), records, embeddings):
+                ops.append({
+                    'op': 'add',
+                    'passage_id': passage_id,
+                    'doc_id': int(doc_id),
+                    'field': PASSAGE_FIELDS.index(record['field']),
+                    'text': record['text'],
+                    'vector': base64.b64encode(vector.tobytes()).decode('ascii')
+                })
+            self._log(ops)
+            self._apply(ops)
+            return [op['passage_id'] for op in ops]
+
+    # Tombstone every live passage of a document (passage IDs survive compaction, so the scan of the
+    # base parents can run outside the lock)
+    def delete_document(self, doc_id):
+        with self.lock:
+            parents, added = self.view.parents, self.added
+        passage_ids = np.flatnonzero(np.asarray(parents) == doc_id).tolist()
+        passage_ids += [passage_id for passage_id, (parent, _, _) in added.items() if parent == doc_id]
+        with self.lock:
+            passage_ids = [passage_id for passage_id in passage_ids if passage_id not in self.tombstones]
+            if passage_ids:
+                op = {'op': 'delete', 'passage_ids': passage_ids}
+                self._log([op])
+                self._apply([op])
+            return passage_ids
+
+    # Drop passage IDs from a writable FAISS index; index types without remove_ids (HNSW) are rebuilt
+    # from their own stored vectors, which still needs no re-embedding
+    def _remove_ids(self, index, passage_ids):
+        try:
+            index.remove_ids(faiss.IDSelectorBatch(passage_ids))
+            return index
+        except RuntimeError:
+            base_index = faiss.downcast_index(index.index)
+            vectors = base_index.reconstruct_n(0, base_index.ntotal)
+            ids = faiss.vector_to_array(index.id_map)
+            keep = ~np.isin(ids, passage_ids)
+            rebuilt = faiss.IndexIDMap2(new_faiss_index(vectors.shape[1], self.index_type, self.metric, train_vectors=vectors[keep]))
+            rebuilt.add_with_ids(vectors[keep], ids[keep])
+            return rebuilt
+
+    # Fold added passages and tombstones into the on-disk artifacts. Everything is built outside the lock
+    # from a snapshot, so searches and updates carry on meanwhile; the lock is only held to swap the files,
+    # keep the log entries written since the snapshot and reopen the new artifacts.
+    # Passage IDs stay positions in the store: a deleted passage keeps an empty slot and parent -1.
+    def compact(self):
+        with self.compaction_lock:
+            with self.lock:
+                view, added, tombstones = self.view, self.added, self.tombstones
+                delta_ids, delta_vectors = self.delta_ids, self.delta_vectors
+                wal_offset = os.path.getsize(self.wal_path) if os.path.exists(self.wal_path) else 0
+            if not added and not tombstones:
+                return
+            deleted = np.array(sorted(tombstones), dtype='int64')
+
+            # Private writable copy of the base index (the served one is a read-only mmap)
+            index = faiss.read_index(os.path.join(self.out_dir, 'faiss_index.index'))
+            if len(deleted):
+                index = self._remove_ids(index, deleted)
+            keep = ~np.isin(delta_ids, deleted)
+            if keep.any():
+                index.add_with_ids(delta_vectors[keep], delta_ids[keep])
+
+            added_ids = sorted(added)
+            parents = np.concatenate([np.asarray(view.parents), np.array([added[i][0] for i in added_ids], dtype='int64')])
+            field_codes = np.concatenate([np.asarray(view.field_codes), np.array([added[i][1] for i in added_ids], dtype='int8')])
+            parents[deleted] = -1
+
+            snapshot = PassageView(view.store, view.parents, view.field_codes, added)
+            prefix = os.path.join(self.out_dir, 'compact_tmp')
+            writer = PassageStoreWriter(prefix + '.passages')
+            writer.add('' if parents[passage_id] < 0 else snapshot.text(passage_id) for passage_id in range(len(parents)))
+            writer.close()
+            faiss.write_index(index, prefix + '.index')
+            del index
+            np.save(prefix + '.fields.npy', field_codes)
+            np.save(prefix + '.parents.npy', parents)
+
+            with self.lock:
+                # The parents array is replaced last: it marks which WAL entries are already part of the base
+                os.replace(prefix + '.passages.bin', os.path.join(self.out_dir, 'passages.bin'))
+                os.replace(prefix + '.passages.offsets.npy', os.path.join(self.out_dir, 'passages.offsets.npy'))
+                os.replace(prefix + '.index', os.path.join(self.out_dir, 'faiss_index.index'))
+                os.replace(prefix + '.fields.npy', os.path.join(self.out_dir, 'passage_fields.npy'))
+                os.replace(prefix + '.parents.npy', os.path.join(self.out_dir, 'passage_parents.npy'))
+
+                # Keep only the log entries written after the snapshot
+                with open(self.wal_path, 'rb') as f:
+                    f.seek(wal_offset)
+                    tail = f.read()
+                with open(self.wal_path + '.tmp', 'wb') as f:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(self.wal_path + '.tmp', self.wal_path)
+
+                self._open()
+                self.added = {passage_id: entry for passage_id, entry in self.added.items() if passage_id not in added}
+                pending = ~np.isin(self.delta_ids, delta_ids)
+                self.delta_ids, self.delta_vectors = self.delta_ids[pending], self.delta_vectors[pending]
+                self.tombstones = self.tombstones - tombstones
+
+    # Compact every `interval` seconds on a daemon thread (call stop_compaction() to end it)
+    def start_compaction(self, interval=300):
+        def run():
+            while not self._stop.wait(interval):
+                self.compact()
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop_compaction(self):
+        self._stop.set()
+
+    # Stop compacting and release the directory for the next writer
+    def close(self):
+        self.stop_compaction()
+        with self.compaction_lock:
+            self.writer_lock.close()  # Closing the file drops the flock
+
+# Example: add a new Q&A, find it right away, then delete it again
+passage_index = MutablePassageIndex(passage_index_dir, model)
+new_doc_id = int(df.index.max()) + 1
+passage_index.add_document(new_doc_id, "What is the first-line drug for type 2 diabetes?", options={'A': 'Metformin'})
+print(passage_index.search(model.encode(preprocess_query("first-line drug for type 2 diabetes")), k=1)[0])
+passage_index.delete_document(new_doc_id)
+passage_index.compact()
+passage_index.close()
+
 """**3**. **LLM Fine Tuning**
 
 """
@@ -164,101 +1169,8 @@ def prepare_t5_format(df):
 
     return inputs, targets
 
-# Prepare the inputs and targets
-inputs, targets = prepare_t5_format(df)
-
-# Tokenize the inputs and targets
-def tokenize_data(inputs, targets):
-    input_encodings = tokenizer(inputs, padding=True, truncation=True, return_tensors="pt")
-    target_encodings = tokenizer(targets, padding=True, truncation=True, return_tensors="pt")
-
-    return input_encodings, target_encodings
-
-# Tokenizing the dataset
-input_encodings, target_encodings = tokenize_data(inputs, targets)
-
-# Create the dataset using the custom class
-train_dataset = QADataset(input_encodings, target_encodings)
-
-# Tokenize the inputs and targets
-def tokenize_data(inputs, targets):
-    input_encodings = tokenizer(inputs, padding=True, truncation=True, return_tensors="pt")
-    target_encodings = tokenizer(targets, padding=True, truncation=True, return_tensors="pt")
-
-    return input_encodings, target_encodings
-
-# Tokenizing the dataset
-input_encodings, target_encodings = tokenize_data(inputs, targets)
-
-import torch
-
-# Create a custom dataset class
-class QADataset(torch.utils.data.Dataset):
-    def __init__(self, input_encodings, target_encodings):
-        self.input_encodings = input_encodings
-        self.target_encodings = target_encodings
-
-    def __getitem__(self, idx):
-        return {
-            'input_ids': self.input_encodings['input_ids'][idx],
-            'attention_mask': self.input_encodings['attention_mask'][idx],
-            'labels': self.target_encodings['input_ids'][idx]
-        }
-
-    def __len__(self):
-        return len(self.input_encodings['input_ids'])
-
-# Create the dataset
-train_dataset = QADataset(input_encodings, target_encodings)
-
-from sklearn.model_selection import train_test_split
-
-# Split the dataframe into training and evaluation sets
-train_df, eval_df = train_test_split(df, test_size=0.1, random_state=42)  # 10% for evaluation
-
-# Prepare the inputs and targets for evaluation
-inputs_eval, targets_eval = prepare_t5_format(eval_df)
-
-# Tokenizing the evaluation dataset
-input_encodings_eval, target_encodings_eval = tokenize_data(inputs_eval, targets_eval)
-
-# Create the eval dataset using the custom class
-eval_dataset = QADataset(input_encodings_eval, target_encodings_eval)
-
-from transformers import Trainer, TrainingArguments
-
-# Define the training arguments
-training_args = TrainingArguments(
-    output_dir="./t5_finetuned_medical_qa",
-    evaluation_strategy="epoch",
-    per_device_train_batch_size=4,  # Adjust based on your GPU memory
-    per_device_eval_batch_size=4,
-    learning_rate=5e-5,
-    num_train_epochs=3,  # More epochs for better training
-    weight_decay=0.01,
-)
-
-
-# Initialize the Trainer
-trainer = Trainer(
-    model=model,
-    args=training_args,
-    train_dataset=train_dataset,
-    eval_dataset=eval_dataset,  # Make sure this is included
-)
-
-
-# Start training
-trainer.train()
-
-print(f"Training dataset size: {len(train_dataset)}")
-print(f"Evaluation dataset size: {len(eval_dataset)}")
-
-# After preparing the datasets, check if they are empty
-if len(inputs) == 0 or len(targets) == 0:
-    print("Training dataset is empty. Please check the data preparation process.")
-if len(inputs_eval) == 0 or len(targets_eval) == 0:
-    print("Evaluation dataset is empty. Please check the data preparation process.")
+# Fine-tuning runs in the training cell further below: token shards with per-batch padding and
+# length-grouped batches (MmapQADataset, DataCollatorForSeq2Seq and LengthGroupedTrainer)
 
 def generate_answer(question):
     input_text = (
@@ -292,31 +1204,13 @@ import torch
 from nltk.tokenize import word_tokenize
 from transformers import T5ForConditionalGeneration, T5Tokenizer
 
-# Load the dataset (limit to the first 300 entries for efficiency)
-def load_dataset(file_path, limit=1000):
-    data = []
-    with open(file_path, 'r') as f:
-        for idx, line in enumerate(f):
-            if idx >= limit:
-                break
-            data.append(json.loads(line))
-    return pd.DataFrame(data)
-
 # Define the file path to your MED_QA.jsonl file
 file_path = "/content/MED_QA.jsonl"
 df = load_dataset(file_path, limit=1000)
 
-# Clean text function
-def clean_text(text):
-    text = re.sub(r'\[.*?\]', '', text)
-    text = re.sub(r'\(.*?\)', '', text)
-    text = re.sub(r'[^a-zA-Z\s]', '', text)
-    text = text.lower()
-    return text
-
-# Apply cleaning to questions and answers
-df['cleaned_question'] = df['question'].apply(clean_text)
-df['cleaned_answer'] = df['answer'].apply(clean_text)
+# Apply cleaning to questions and answers (clean_texts from the data preparation section)
+df['cleaned_question'] = clean_texts(df['question'])
+df['cleaned_answer'] = clean_texts(df['answer'])
 
 # Mapping answer options to full text
 def map_option_to_answer(row):
@@ -341,78 +1235,26 @@ def prepare_t5_format(df):
 
     return inputs, targets
 
-# Prepare the inputs and targets
-inputs, targets = prepare_t5_format(df)
-
 # Load pre-trained T5 model and tokenizer
 model_name = "t5-small"  # You can use 't5-base' or 't5-large' for larger models
 model = T5ForConditionalGeneration.from_pretrained(model_name)
 tokenizer = T5Tokenizer.from_pretrained(model_name)
 
-# Tokenize the inputs and targets
-def tokenize_data(inputs, targets):
-    input_encodings = tokenizer(inputs, padding=True, truncation=True, return_tensors="pt")
-    target_encodings = tokenizer(targets, padding=True, truncation=True, return_tensors="pt")
-    return input_encodings, target_encodings
-
-input_encodings, target_encodings = tokenize_data(inputs, targets)
-
-# Custom Dataset class for fine-tuning
-class QADataset(torch.utils.data.Dataset):
-    def __init__(self, input_encodings, target_encodings):
-        self.input_encodings = input_encodings
-        self.target_encodings = target_encodings
-
-    def __getitem__(self, idx):
-        return {
-            'input_ids': self.input_encodings['input_ids'][idx],
-            'attention_mask': self.input_encodings['attention_mask'][idx],
-            'labels': self.target_encodings['input_ids'][idx]
-        }
-
-    def __len__(self):
-        return len(self.input_encodings['input_ids'])
-
-# Create the dataset for training
-train_dataset = QADataset(input_encodings, target_encodings)
-
-# Verify everything is correct by checking the dataset
-print(f"Training dataset size: {len(train_dataset)}")
-
-# You can now proceed with training the model as defined previously.
+# Training on this data happens in the next cell (token shards, per-batch padding).
 
 import json
 import pandas as pd
 import re
 import torch
-from sklearn.model_selection import train_test_split
 from transformers import T5ForConditionalGeneration, T5Tokenizer
 
-# Load the dataset (limit to the first 300 entries for efficiency)
-def load_dataset(file_path, limit=1000):
-    data = []
-    with open(file_path, 'r') as f:
-        for idx, line in enumerate(f):
-            if idx >= limit:
-                break
-            data.append(json.loads(line))
-    return pd.DataFrame(data)
-
 # Define the file path to your MED_QA.jsonl file
 file_path = "/content/MED_QA.jsonl"
 df = load_dataset(file_path, limit=1000)
 
-# Clean text function
-def clean_text(text):
-    text = re.sub(r'\[.*?\]', '', text)
-    text = re.sub(r'\(.*?\)', '', text)
-    text = re.sub(r'[^a-zA-Z\s]', '', text)
-    text = text.lower()
-    return text
-
-# Apply cleaning to questions and answers
-df['cleaned_question'] = df['question'].apply(clean_text)
-df['cleaned_answer'] = df['answer'].apply(clean_text)
+# Apply cleaning to questions and answers (clean_texts from the data preparation section)
+df['cleaned_question'] = clean_texts(df['question'])
+df['cleaned_answer'] = clean_texts(df['answer'])
 
 # Mapping answer options to full text
 def map_option_to_answer(row):
@@ -437,50 +1279,109 @@ def prepare_t5_format(df):
 
     return inputs, targets
 
-# Split the dataset into training and evaluation sets (90% train, 10% eval)
-train_df, eval_df = train_test_split(df, test_size=0.1, random_state=42)
+# Train/eval assignment from a hash of the question instead of a random draw, so the streamed token
+# shards below and eval_df (used by the decoding, quantization and backend benchmarks) always agree
+def is_eval_question(questions, test_size=0.1):
+    return np.array([int.from_bytes(hashlib.blake2b(question.encode('utf-8'), digest_size=8).digest(), 'big') / 2**64 < test_size for question in questions], dtype=bool)
 
-# Prepare the inputs and targets for both train and eval sets
-train_inputs, train_targets = prepare_t5_format(train_df)
-eval_inputs, eval_targets = prepare_t5_format(eval_df)
+# Split the dataset into training and evaluation sets (90% train, 10% eval)
+is_eval = is_eval_question(df['question'], test_size=0.1)
+train_df, eval_df = df[~is_eval], df[is_eval]
 
 # Load pre-trained T5 model and tokenizer
 model_name = "t5-small"  # You can use 't5-base' or 't5-large' for larger models
 model = T5ForConditionalGeneration.from_pretrained(model_name)
 tokenizer = T5Tokenizer.from_pretrained(model_name)
 
-# Tokenize the inputs and targets
-def tokenize_data(inputs, targets):
-    input_encodings = tokenizer(inputs, padding=True, truncation=True, return_tensors="pt")
-    target_encodings = tokenizer(targets, padding=True, truncation=True, return_tensors="pt")
-    return input_encodings, target_encodings
-
-# Tokenize training and evaluation data
-train_input_encodings, train_target_encodings = tokenize_data(train_inputs, train_targets)
-eval_input_encodings, eval_target_encodings = tokenize_data(eval_inputs, eval_targets)
-
-# Custom Dataset class for fine-tuning
-class QADataset(torch.utils.data.Dataset):
-    def __init__(self, input_encodings, target_encodings):
-        self.input_encodings = input_encodings
-        self.target_encodings = target_encodings
+# Appends tokenized examples to flat int32 token files, with an int64 offsets index per field
+# (example i of a field is tokens[offsets[i]:offsets[i + 1]])
+class TokenShardWriter:
+    FIELDS = ('input_ids', 'labels')
+
+    def __init__(self, prefix):
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        self.prefix = prefix
+        self.files = {field: open(f"{prefix}.{field}.int32", 'wb') for field in self.FIELDS}
+        self.offsets = {field: [0] for field in self.FIELDS}
+
+    def write(self, inputs, targets, max_length=512):
+        if not inputs:
+            return
+        for field, texts in zip(self.FIELDS, (inputs, targets)):
+            for ids in tokenizer(texts, truncation=True, max_length=max_length)['input_ids']:
+                self.files[field].write(np.asarray(ids, dtype='int32').tobytes())
+                self.offsets[field].append(self.offsets[field][-1] + len(ids))
+
+    def close(self):
+        for field, f in self.files.items():
+            f.close()
+            np.save(f"{self.prefix}.{field}.offsets.npy", np.array(self.offsets[field], dtype='int64'))
+
+# One-time preprocessing command: stream MED_QA.jsonl, clean and format it for T5, split off an eval set
+# and write both splits as token shards, so later training runs skip all of this
+def preprocess_to_token_shards(file_path, out_dir, limit=None, test_size=0.1, batch_size=50000, max_length=512):
+    writers = {split: TokenShardWriter(os.path.join(out_dir, split)) for split in ('train', 'eval')}
+    rows = 0
+    for batch, _ in iter_dataset_batches(file_path, batch_size):
+        if limit is not None:
+            batch = batch.iloc[:limit - rows].copy()
+        rows += len(batch)
+        batch['cleaned_question'] = clean_texts(batch['question'])
+        batch['full_answer_text'] = batch.apply(map_option_to_answer, axis=1)
+        is_eval = is_eval_question(batch['question'], test_size)
+        for split, split_df in (('train', batch[~is_eval]), ('eval', batch[is_eval])):
+            split_inputs, split_targets = prepare_t5_format(split_df)
+            writers[split].write(split_inputs, split_targets, max_length=max_length)
+        if limit is not None and rows >= limit:
+            break
+    for writer in writers.values():
+        writer.close()
+
+# Dataset over the token shards: both token files are memory-mapped, so startup is instant
+# and datasets larger than RAM only page in the examples a batch actually touches
+class MmapQADataset(torch.utils.data.Dataset):
+    def __init__(self, prefix):
+        self.tokens = {}
+        self.offsets = {}
+        for field in TokenShardWriter.FIELDS:
+            self.offsets[field] = np.load(f"{prefix}.{field}.offsets.npy", mmap_mode='r')
+            path = f"{prefix}.{field}.int32"
+            self.tokens[field] = np.memmap(path, dtype='int32', mode='r') if os.path.getsize(path) else np.empty(0, dtype='int32')
+        self.lengths = np.diff(self.offsets['input_ids']).tolist()  # Exact lengths for LengthGroupedTrainer
 
     def __getitem__(self, idx):
-        return {
-            'input_ids': self.input_encodings['input_ids'][idx],
-            'attention_mask': self.input_encodings['attention_mask'][idx],
-            'labels': self.target_encodings['input_ids'][idx]
-        }
+        item = {}
+        for field in TokenShardWriter.FIELDS:
+            start, end = self.offsets[field][idx], self.offsets[field][idx + 1]
+            item[field] = self.tokens[field][start:end].tolist()
+        item['attention_mask'] = [1] * len(item['input_ids'])
+        return item
 
     def __len__(self):
-        return len(self.input_encodings['input_ids'])
+        return len(self.offsets['input_ids']) - 1
 
-# Create the dataset for training and evaluation
-train_dataset = QADataset(train_input_encodings, train_target_encodings)
-eval_dataset = QADataset(eval_input_encodings, eval_target_encodings)
+# Create the dataset for training and evaluation from the token shards (written once, then reused).
+# Examples are stored unpadded; DataCollatorForSeq2Seq pads each batch to its own longest example.
+token_shard_dir = './t5_token_shards'
+if not os.path.exists(os.path.join(token_shard_dir, 'eval.labels.offsets.npy')):
+    preprocess_to_token_shards(file_path, token_shard_dir, limit=1000)
+train_dataset = MmapQADataset(os.path.join(token_shard_dir, 'train'))
+eval_dataset = MmapQADataset(os.path.join(token_shard_dir, 'eval'))
 
 # Define the training arguments and the trainer object
-from transformers import Trainer, TrainingArguments
+from transformers import Trainer, TrainingArguments, DataCollatorForSeq2Seq
+from transformers.trainer_pt_utils import LengthGroupedSampler
+
+# Pads each batch to its own longest example; padded label positions become -100 so the loss ignores them
+data_collator = DataCollatorForSeq2Seq(tokenizer, model=model, label_pad_token_id=-100)
+
+# Trainer whose training batches are drawn from examples of similar length, keeping per-batch padding small
+class LengthGroupedTrainer(Trainer):
+    def _get_train_sampler(self, *args, **kwargs):
+        lengths = getattr(self.train_dataset, 'lengths', None)
+        if lengths is None:
+            return super()._get_train_sampler(*args, **kwargs)
+        return LengthGroupedSampler(self.args.train_batch_size * self.args.gradient_accumulation_steps, lengths=lengths)
 
 training_args = TrainingArguments(
     output_dir='./t5_finetuned_medqa',
@@ -498,11 +1399,12 @@ training_args = TrainingArguments(
 )
 
 
-trainer = Trainer(
+trainer = LengthGroupedTrainer(
     model=model,
     args=training_args,
     train_dataset=train_dataset,
-    eval_dataset=eval_dataset
+    eval_dataset=eval_dataset,
+    data_collator=data_collator
 )
 
 # Start training
@@ -519,18 +1421,75 @@ model_name = "t5-small"  # Change this if you're using 't5-base' or 't5-large'
 model = T5ForConditionalGeneration.from_pretrained('/content/t5_finetuned_medqa/checkpoint-1100')  # Use your fine-tuned model path
 tokenizer = T5Tokenizer.from_pretrained(model_name)
 
-# Function to generate an answer for a given question
-# Function to generate an answer for a given question
-def generate_answer(question):
+import time
+import torch
+
+# Decoding modes, from best quality to cheapest. Beam search over 5 beams costs about five times the
+# decoder compute of greedy decoding; the capped mode also bounds how long an answer can run.
+DECODING_MODES = {
+    'beam': {'num_beams': 5, 'max_new_tokens': 150, 'early_stopping': True},
+    'small_beam': {'num_beams': 2, 'max_new_tokens': 150, 'early_stopping': True},
+    'greedy': {'num_beams': 1, 'max_new_tokens': 150},
+    'greedy_capped': {'num_beams': 1, 'max_new_tokens': 48},
+}
+
+# Picks a decoding mode per request: the best mode whose predicted latency fits the request's target.
+# Predicted latency = encoder cost per input token * input length + decoder cost per step * typical
+# number of steps, with all three measured per mode by calibrate() on sample inputs of the model that serves.
+# Requests without a target get `default_mode`.
+class DecodingPolicy:
+    def __init__(self, modes=DECODING_MODES, default_mode='beam'):
+        self.modes = modes
+        self.default_mode = default_mode
+        self.encode_ms_per_token = 0
+        self.step_ms = {}
+        self.mean_steps = {}
+
+    def calibrate(self, model, tokenizer, input_texts):
+        encodings = [tokenizer(text, return_tensors='pt', max_length=512, truncation=True).input_ids for text in input_texts]
+        with torch.no_grad():
+            start = time.perf_counter()
+            for input_ids in encodings:
+                model.get_encoder()(input_ids=input_ids, attention_mask=torch.ones_like(input_ids))
+            encode_ms = (time.perf_counter() - start) * 1000
+        self.encode_ms_per_token = encode_ms / sum(input_ids.shape[1] for input_ids in encodings)
+        for mode, generate_kwargs in self.modes.items():
+            steps = 0
+            start = time.perf_counter()
+            for input_ids in encodings:
+                steps += model.generate(input_ids, **generate_kwargs).shape[1] - 1
+            decode_ms = (time.perf_counter() - start) * 1000 - encode_ms
+            self.step_ms[mode] = max(decode_ms, 0) / max(steps, 1)
+            self.mean_steps[mode] = steps / len(encodings)
+        return self
+
+    def predict_ms(self, mode, input_length):
+        return self.encode_ms_per_token * input_length + self.step_ms[mode] * self.mean_steps[mode]
+
+    # Without a target (or before calibration) the default mode is used; if no mode fits, the cheapest one
+    def choose(self, input_length, latency_ms=None):
+        if latency_ms is None or not self.step_ms:
+            return self.default_mode
+        for mode in self.modes:
+            if self.predict_ms(mode, input_length) <= latency_ms:
+                return mode
+        return list(self.modes)[-1]
+
+decoding_policy = DecodingPolicy().calibrate(model, tokenizer, ["question: what is the treatment for diabetes", "question: what are the symptoms of asthma in children"])
+
+# Function to generate an answer for a given question, optionally within a latency target (in ms)
+def generate_answer(question, latency_ms=None):
     input_text = f"question: {question}"  # Format the input as a question
     input_ids = tokenizer(input_text, return_tensors="pt").input_ids  # Tokenize input
-    outputs = model.generate(input_ids, max_new_tokens=150, num_beams=5, early_stopping=True)  # Generate answer
+    mode = decoding_policy.choose(input_ids.shape[1], latency_ms)
+    outputs = model.generate(input_ids, **DECODING_MODES[mode])  # Generate answer
     answer = tokenizer.decode(outputs[0], skip_special_tokens=True)  # Decode generated tokens to text
     return answer
 
 # Example usage:
 test_question = "What is the treatment for diabetes?"
 generated_answer = generate_answer(test_question)
+fast_answer = generate_answer(test_question, latency_ms=200)
 
 print(f"Question: {test_question}")
 print(f"Generated Answer: {generated_answer}")
@@ -592,16 +1551,12 @@ corpus = [
 # Generate embeddings for the updated corpus
 corpus_embeddings = model.encode(corpus, convert_to_tensor=False)
 
-# Convert embeddings to a numpy array
-corpus_embeddings = np.array(corpus_embeddings)
+# Offline build step: create the FAISS index (L2 distance) and save it together with the passage store
+retrieval_dir = "retrieval_artifacts"
+build_retrieval_artifacts(corpus, corpus_embeddings, retrieval_dir)
 
-# Create a FAISS index
-d = corpus_embeddings.shape[1]  # Dimension of embeddings
-index = faiss.IndexFlatL2(d)  # L2 distance (Euclidean)
-index.add(corpus_embeddings)  # Add embeddings to the index
-
-# Save the FAISS index (optional)
-faiss.write_index(index, "faiss_index.index")
+# Service startup: memory-map the index and the passage store
+index, passage_store = load_retrieval_artifacts(retrieval_dir)
 
 # Define the function to embed the user query
 def embed_query(query):
@@ -614,10 +1569,10 @@ def retrieve_passages(query, n=5):
     query_embedding = embed_query(query)
 
     # Search the FAISS index for the top n passages
-    distances, indices = index.search(np.array([query_embedding]), n)
+    distances, indices = index.search(np.array([query_embedding], dtype='float32'), n)
 
     # Retrieve passages based on indices
-    retrieved_passages = [corpus[i] for i in indices[0]]  # Map index to the original corpus
+    retrieved_passages = [passage_store[i] for i in indices[0] if i >= 0]  # Map index to the stored passages
     return retrieved_passages
 
 # Function to generate an answer from the query and retrieved passages (assuming you have an LLM for this)
@@ -679,48 +1634,77 @@ app = Flask(__name__)
 from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
+import queue
+import threading
+from concurrent.futures import Future
+
+# Dynamic micro-batcher: concurrent requests are queued, and a bounded pool of `num_workers` threads
+# runs them through `batch_fn` together once `max_batch_size` items are waiting or the first one has
+# waited `max_wait_ms`. `batch_fn` takes a list of items and returns a list of results in the same order.
+# With `max_pending` set, at most that many requests may wait; beyond it submit() raises queue.Full.
+class MicroBatcher:
+    def __init__(self, batch_fn, max_batch_size=16, max_wait_ms=10, num_workers=1, max_pending=None):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue(maxsize=max_pending or 0)
+        self.workers = [threading.Thread(target=self._run, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    # Queue one item; the returned Future resolves to this caller's own result
+    def submit(self, item):
+        future = Future()
+        self.requests.put_nowait((item, future))  # Raises queue.Full when the queue is saturated
+        return future
+
+    def pending(self):
+        return self.requests.qsize()
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]  # Block until the first request arrives
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.batch_fn([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
 
 # Load a pre-trained sentence transformer model
 model = SentenceTransformer('all-MiniLM-L6-v2')  # You can use any other model
 
-# Updated corpus with relevant medical information
-corpus = [
-    "Diabetes is a chronic condition that affects how your body turns food into energy.",
-    "Symptoms of diabetes include increased thirst, frequent urination, and fatigue.",
-    "The Great Wall of China is an ancient series of walls and fortifications.",
-    "Chocolate cake is made by combining sugar, butter, flour, and cocoa powder.",
-    "The boiling point of water is 100 degrees Celsius at sea level."
-]
-
-# Generate embeddings for the updated corpus
-corpus_embeddings = model.encode(corpus, convert_to_tensor=False)
-
-# Convert embeddings to a numpy array
-corpus_embeddings = np.array(corpus_embeddings)
-
-# Create a FAISS index
-d = corpus_embeddings.shape[1]  # Dimension of embeddings
-index = faiss.IndexFlatL2(d)  # L2 distance (Euclidean)
-index.add(corpus_embeddings)  # Add embeddings to the index
-
-# Save the FAISS index (optional)
-faiss.write_index(index, "faiss_index.index")
+# Open the passage-level index over the dataset (written by build_passage_index); documents can be
+# added and deleted while serving, and the changes are compacted into the index every 5 minutes
+passage_index = MutablePassageIndex("passage_index", model)
+passage_index.start_compaction(interval=300)
 
-# Define the function to embed the user query
+# Define the function to embed the user query (cleaned like the indexed passages)
 def embed_query(query):
-    query_embedding = model.encode([query], convert_to_tensor=False)[0]  # Embed query and return first result
+    query_embedding = model.encode([preprocess_query(query)], convert_to_tensor=False)[0]  # Embed query and return first result
     return query_embedding
 
 # Define a function to retrieve passages
-def retrieve_passages(query, n=5):
+def retrieve_passages(query, n=5, num_candidates=20, budget_ms=50):
     # Convert the query into an embedding
     query_embedding = embed_query(query)
 
-    # Search the FAISS index for the top n passages
-    distances, indices = index.search(np.array([query_embedding]), n)
-
-    # Retrieve passages based on indices
-    retrieved_passages = [corpus[i] for i in indices[0]]  # Map index to the original corpus
+    # Search the passage index wide, then keep the n passages the cross-encoder ranks best
+    hits = passage_index.search(query_embedding, k=num_candidates)[0]
+    ranked = reranker.rerank(query, [hit['text'] for hit in hits], n=n, budget_ms=budget_ms)
+    retrieved_passages = [hits[position]['text'] for position, _ in ranked]
     return retrieved_passages
 
 # Function to generate an answer from the query and retrieved passages (assuming you have an LLM for this)
@@ -728,6 +1712,18 @@ def generate_answer(query, retrieved_passages):
     # For simplicity, we'll return the retrieved passages as the "answer"
     return f"Query: {query}\nRetrieved Passages: {retrieved_passages}"
 
+# Answer a batch of queries with one encoder pass, one FAISS search and one reranking pass
+def answer_queries(queries, n=5, num_candidates=20, budget_ms=100):
+    cleaned_queries = [preprocess_query(query) for query in queries]
+    query_embeddings = model.encode(cleaned_queries, batch_size=len(queries), convert_to_tensor=False)
+    hits = passage_index.search(query_embeddings, k=num_candidates)
+    candidate_lists = [[hit['text'] for hit in query_hits] for query_hits in hits]
+    ranked = reranker.rerank_batch(queries, candidate_lists, n=n, budget_ms=budget_ms)
+    return [generate_answer(query, [candidates[position] for position, _ in query_ranked]) for query, candidates, query_ranked in zip(queries, candidate_lists, ranked)]
+
+# Concurrent /generate requests are gathered for up to 5 ms (or 32 queries) and answered together
+generate_batcher = MicroBatcher(answer_queries, max_batch_size=32, max_wait_ms=5, max_pending=256)
+
 
 input_ids = tokenizer(input_text, return_tensors="pt", clean_up_tokenization_spaces=True).input_ids
 
@@ -745,14 +1741,37 @@ def generate():
     user_query = data.get('query', '')
 
     if user_query:
-        retrieved_passages = retrieve_passages(user_query)
-        answer = generate_answer(user_query, retrieved_passages)
+        try:
+            future = generate_batcher.submit(user_query)
+        except queue.Full:
+            return jsonify({'error': 'Server is busy, please retry'}), 429, {'Retry-After': '1'}
+        answer = future.result()
         return jsonify({'query': user_query, 'answer': answer})
     else:
         return jsonify({'error': 'No query provided'}), 400
 
+# Add a Q&A document to the retrieval index; it is searchable as soon as the request returns
+@app.route('/documents', methods=['POST'])
+def add_document():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'doc_id' not in data or not data.get('question'):
+        return jsonify({'error': 'doc_id and question are required'}), 400
+    try:
+        doc_id = int(data['doc_id'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'doc_id must be an integer'}), 400
+    passage_ids = passage_index.add_document(doc_id, data['question'], data.get('answer', ''), data.get('options'))
+    return jsonify({'doc_id': doc_id, 'passages': len(passage_ids)}), 201
+
+@app.route('/documents/<int:doc_id>', methods=['DELETE'])
+def delete_document(doc_id):
+    passage_ids = passage_index.delete_document(doc_id)
+    if not passage_ids:
+        return jsonify({'error': 'Unknown document'}), 404
+    return jsonify({'doc_id': doc_id, 'passages': len(passage_ids)})
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)  # One thread per request, so requests can meet in the batcher
 
 
 
@@ -796,25 +1815,63 @@ def embed_query(query):
     query_embedding = sentence_model.encode([query], convert_to_tensor=False)[0]
     return query_embedding
 
+# Function to embed a batch of queries in one forward pass
+def embed_queries(queries):
+    query_embeddings = sentence_model.encode(list(queries), batch_size=max(len(queries), 1), convert_to_tensor=False)
+    return np.asarray(query_embeddings, dtype='float32')
+
+# Batched retrieval: one encoder pass and one FAISS search for all queries.
+# Returns the passages for each query plus (num_queries, n) arrays of distances and corpus indices.
+def retrieve_passages_batch(queries, n=5):
+    query_embeddings = embed_queries(queries)
+    distances, indices = index.search(query_embeddings, n)
+    retrieved_passages = [[corpus[i] for i in row if i >= 0] for row in indices]  # FAISS pads missing hits with -1
+    return retrieved_passages, distances, indices
+
 # Function to retrieve passages
 def retrieve_passages(query, n=5):
-    query_embedding = embed_query(query)
-    distances, indices = index.search(np.array([query_embedding]), n)
-    retrieved_passages = [corpus[i] for i in indices[0]]
-    return retrieved_passages
-
-# Prepare input for the T5 model
-def prepare_input(query, retrieved_passages):
-    passages = " ".join(retrieved_passages)
+    retrieved_passages, _, _ = retrieve_passages_batch([query], n)
+    return retrieved_passages[0]
+
+from functools import lru_cache
+
+# T5 token count of a text, cached (the same passages come back for many queries)
+@lru_cache(maxsize=100000)
+def t5_token_count(text):
+    return len(tokenizer(text, add_special_tokens=False).input_ids)
+
+# Pick the passages that go into the T5 context, in score order (best first):
+# - a passage whose word set overlaps one already taken by Jaccard similarity >= dedup_threshold is skipped,
+# - a passage that does not fit in the tokens left of `max_tokens` is skipped instead of being cut off
+#   (only the best passage is ever truncated, when even it does not fit on its own).
+def build_context(query, passages, max_tokens=512, dedup_threshold=0.8):
+    budget = max_tokens - t5_token_count(f"question: {query} context:") - 1  # 1 token for </s>
+    selected, selected_words = [], []
+    for passage in passages:
+        words = frozenset(passage.lower().split())
+        if any(len(words & other) >= dedup_threshold * len(words | other) for other in selected_words):
+            continue
+        tokens = t5_token_count(passage)
+        if tokens > budget:
+            if selected or budget <= 0:
+                continue
+            passage = tokenizer.decode(tokenizer(passage, add_special_tokens=False).input_ids[:budget])
+            tokens = budget
+        selected.append(passage)
+        selected_words.append(words)
+        budget -= tokens
+    return selected
+
+# Prepare input for the T5 model: the packed context fits in max_tokens, so truncation never cuts a passage
+def prepare_input(query, retrieved_passages, max_tokens=512):
+    passages = " ".join(build_context(query, retrieved_passages, max_tokens))
     return f"question: {query} context: {passages}"
 
 # Function to generate answers in batch
 def batch_generate(queries, n=5):
-    inputs = []
-    for query in queries:
-        retrieved_passages = retrieve_passages(query, n)
-        input_text = prepare_input(query, retrieved_passages)
-        inputs.append(input_text)
+    # Retrieve for all queries at once (one embedding pass, one FAISS search)
+    retrieved_passages, _, _ = retrieve_passages_batch(queries, n)
+    inputs = [prepare_input(query, passages) for query, passages in zip(queries, retrieved_passages)]
 
     # Tokenize all inputs at once
     inputs_tokenized = tokenizer(inputs, return_tensors='pt', max_length=512, truncation=True, padding=True)
@@ -832,17 +1889,23 @@ generated_answers = batch_generate(batch_queries)
 for answer in generated_answers:
     print(answer)
 
+# Retrieve wide for all queries at once (one embedding pass, one FAISS search), then rerank
+# every query's candidates in one cross-encoder pass and keep the best n for T5
+def retrieve_context(queries, n=3, num_candidates=5, budget_ms=100):
+    candidate_lists, _, _ = retrieve_passages_batch(queries, num_candidates)
+    ranked = reranker.rerank_batch(queries, candidate_lists, n=n, budget_ms=budget_ms)
+    return [[candidates[position] for position, _ in query_ranked] for candidates, query_ranked in zip(candidate_lists, ranked)]
+
 # If using batching, you can modify the retrieval and LLM code like so:
-def batch_generate(queries, n=5):
-    inputs = []
-    for query in queries:
-        retrieved_passages = retrieve_passages(query, n)
-        input_text = prepare_input(query, retrieved_passages)
-        inputs.append(input_text)
+def batch_generate(queries, n=3, num_candidates=5, budget_ms=100, context_tokens=512, latency_ms=None):
+    retrieved_passages = retrieve_context(queries, n, num_candidates, budget_ms)
+    inputs = [prepare_input(query, passages, context_tokens) for query, passages in zip(queries, retrieved_passages)]
 
-    # Tokenize all inputs at once
-    inputs_tokenized = tokenizer(inputs, return_tensors='pt', max_length=512, truncation=True, padding=True)
-    outputs = model.generate(**inputs_tokenized)
+    # Tokenize all inputs at once (each input is packed to at most context_tokens tokens)
+    inputs_tokenized = tokenizer(inputs, return_tensors='pt', max_length=context_tokens, truncation=True, padding=True)
+    # Decoding mode for the batch from the latency target and its (padded) input length
+    mode = decoding_policy.choose(inputs_tokenized.input_ids.shape[1], latency_ms)
+    outputs = model.generate(**inputs_tokenized, **DECODING_MODES[mode])
 
     return [tokenizer.decode(output, skip_special_tokens=True) for output in outputs]
 
@@ -852,6 +1915,194 @@ generated_answers = batch_generate(batch_queries)
 for answer in generated_answers:
     print(answer)
 
+import threading
+from collections import OrderedDict
+from transformers.modeling_outputs import BaseModelOutput
+
+# T5 encoder states of each passage, encoded on its own: an in-memory LRU of at most `max_bytes` of states
+# (a 256-token t5-small passage takes 0.5 MB), backed by one file per passage in `cache_dir` when set. Entries are keyed on a hash of the passage text and
+# `model_id` (model name or path plus backend), so a rebuilt corpus or a different serving model never
+# reads states that belong to other text or weights.
+class EncoderStateCache:
+    def __init__(self, model, tokenizer, model_id, max_bytes=512 * 2 ** 20, cache_dir=None, max_passage_tokens=256):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.cache_dir = cache_dir
+        self.max_passage_tokens = max_passage_tokens
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, passage):
+        return hashlib.blake2b(f"{self.model_id}\0{self.max_passage_tokens}\0{passage}".encode('utf-8'), digest_size=16).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def _put(self, key, states):
+        with self.lock:
+            if key in self.states:
+                self.size_bytes -= self.states[key].nbytes
+            self.states[key] = states
+            self.states.move_to_end(key)
+            self.size_bytes += states.nbytes
+            while self.size_bytes > self.max_bytes and len(self.states) > 1:
+                self.size_bytes -= self.states.popitem(last=False)[1].nbytes
+
+    # Written under a temporary name and renamed into place, so the other batcher worker never loads a
+    # half-written file
+    def _save(self, key, states):
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        torch.save(states, tmp_path)
+        os.replace(tmp_path, self._path(key))
+
+    # Encoder states, (passage tokens, d_model), of every passage; the ones not cached are encoded in one batch
+    def get(self, passages):
+        keys = [self.key(passage) for passage in passages]
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.states:
+                    self.states.move_to_end(key)
+                    found[key] = self.states[key]
+        for key in keys:
+            if key not in found and self.cache_dir and os.path.exists(self._path(key)):
+                found[key] = torch.load(self._path(key))
+                self._put(key, found[key])
+        missing = [(key, passage) for key, passage in dict(zip(keys, passages)).items() if key not in found]
+        with self.lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            encoded = self.tokenizer([passage for _, passage in missing], return_tensors='pt', max_length=self.max_passage_tokens, truncation=True, padding=True)
+            with torch.no_grad():
+                hidden_states = self.model.get_encoder()(**encoded).last_hidden_state
+            for (key, _), states, mask in zip(missing, hidden_states, encoded.attention_mask):
+                found[key] = states[:int(mask.sum())].clone()  # Drop the padding
+                self._put(key, found[key])
+                if self.cache_dir:
+                    self._save(key, found[key])
+        return [found[key] for key in keys]
+
+# Fusion-in-Decoder style generation: only the short question is encoded per request. Its states are
+# concatenated with the cached states of each retrieved passage, and the decoder cross-attends over the
+# whole sequence, so encoder cost no longer grows with the context. Passages do not see the question
+# (or each other) in the encoder, so answers are best once T5 is fine-tuned in this format.
+def fid_batch_generate(queries, n=3, num_candidates=5, budget_ms=100, latency_ms=None):
+    passages = retrieve_context(queries, n, num_candidates, budget_ms)
+    questions = tokenizer([f"question: {query} context:" for query in queries], return_tensors='pt', max_length=64, truncation=True, padding=True)
+    with torch.no_grad():
+        question_states = model.get_encoder()(**questions).last_hidden_state
+    sequences = []
+    for states, mask, query_passages in zip(question_states, questions.attention_mask, passages):
+        sequences.append(torch.cat([states[:int(mask.sum())]] + encoder_state_cache.get(query_passages)))
+
+    # Pad the per-query sequences into one batch for the decoder
+    max_length = max(len(sequence) for sequence in sequences)
+    encoder_states = torch.zeros(len(sequences), max_length, sequences[0].shape[-1], dtype=sequences[0].dtype)
+    attention_mask = torch.zeros(len(sequences), max_length, dtype=torch.long)
+    for i, sequence in enumerate(sequences):
+        encoder_states[i, :len(sequence)] = sequence
+        attention_mask[i, :len(sequence)] = 1
+
+    # Only the question goes through the encoder per request, so its length is what the policy sees
+    mode = decoding_policy.choose(questions.input_ids.shape[1], latency_ms)
+    outputs = model.generate(encoder_outputs=BaseModelOutput(last_hidden_state=encoder_states), attention_mask=attention_mask, **DECODING_MODES[mode])
+    return [tokenizer.decode(output, skip_special_tokens=True) for output in outputs]
+
+encoder_state_cache = EncoderStateCache(model, tokenizer, f"{model_name}:fp32", cache_dir="t5_passage_states")
+
+# Same queries in FiD mode; repeated passages are now served from the cache
+generated_answers = fid_batch_generate(batch_queries)
+for answer in generated_answers:
+    print(answer)
+print(f"Passage state cache: {encoder_state_cache.hits} hits, {encoder_state_cache.misses} misses")
+
+from collections import OrderedDict
+
+NUMBER_PATTERN = re.compile(r'\d+(?:\.\d+)?')
+
+# Two-tier answer cache in front of the RAG path:
+#   1. exact-match LRU keyed on the query, lowercased and with whitespace collapsed. clean_text is not used
+#      here: it strips digits and brackets, which would make "10 kg" and "40 kg" the same question.
+#   2. nearest-neighbour tier over the embeddings of cached queries (hit when cosine similarity >= threshold
+#      and both queries contain the same numbers)
+# Entries expire after `ttl` seconds; beyond `max_size` the least recently used entry is evicted.
+class AnswerCache:
+    def __init__(self, encoder, max_size=10000, ttl=3600, similarity_threshold=0.95):
+        self.encoder = encoder
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()  # normalized query -> (answer, slot, expiry time)
+        self.embeddings = np.zeros((max_size, encoder.get_sentence_embedding_dimension()), dtype='float32')
+        self.slot_keys = [None] * max_size
+        self.free_slots = list(range(max_size - 1, -1, -1))
+        self.lock = threading.Lock()
+        self.stats = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0}
+
+    def normalize(self, query):
+        return ' '.join(query.lower().split())
+
+    def _remove(self, key):
+        _, slot, _ = self.entries.pop(key)
+        self.embeddings[slot] = 0  # A zero row can never pass the similarity threshold
+        self.slot_keys[slot] = None
+        self.free_slots.append(slot)
+
+    # Returns (answer or None, normalized key, query embedding); pass the last two to store() on a miss
+    def lookup(self, query):
+        key = self.normalize(query)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] > now:
+                self.entries.move_to_end(key)
+                self.stats['exact_hits'] += 1
+                return entry[0], key, None
+            if entry is not None:
+                self._remove(key)
+
+        embedding = self.encoder.encode(key, normalize_embeddings=True).astype('float32')
+        with self.lock:
+            if self.entries:
+                scores = self.embeddings @ embedding
+                slot = int(np.argmax(scores))
+                match = self.slot_keys[slot]
+                if scores[slot] >= self.similarity_threshold and match is not None and NUMBER_PATTERN.findall(match) == NUMBER_PATTERN.findall(key):
+                    answer, _, expiry = self.entries[match]
+                    if expiry > now:
+                        self.entries.move_to_end(match)
+                        self.stats['semantic_hits'] += 1
+                        return answer, key, embedding
+                    self._remove(match)
+            self.stats['misses'] += 1
+        return None, key, embedding
+
+    def store(self, key, embedding, answer):
+        if embedding is None:
+            embedding = self.encoder.encode(key, normalize_embeddings=True).astype('float32')
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if not self.free_slots:
+                self._remove(next(iter(self.entries)))  # Evict the least recently used entry
+            slot = self.free_slots.pop()
+            self.embeddings[slot] = embedding
+            self.slot_keys[slot] = key
+            self.entries[key] = (answer, slot, time.monotonic() + self.ttl)
+
+    def metrics(self):
+        with self.lock:
+            lookups = sum(self.stats.values())
+            hits = self.stats['exact_hits'] + self.stats['semantic_hits']
+            return {**self.stats, 'size': len(self.entries), 'hit_rate': hits / lookups if lookups else 0.0}
+
 
 
 # Test Dataset
@@ -953,6 +2204,216 @@ print(f"ROUGE Scores: {rouge}")
 
 error_analysis(generated_answers, test_data)
 
+# Benchmark each decoding mode on the eval split: latency, generated tokens per second, BLEU and ROUGE
+def benchmark_decoding_modes(model, tokenizer, eval_data, modes=DECODING_MODES):
+    report = []
+    for mode, generate_kwargs in modes.items():
+        generated_answers, latencies_ms, tokens = [], [], 0
+        for item in eval_data:
+            input_ids = tokenizer(f"question: {item['question']}", return_tensors='pt', max_length=512, truncation=True).input_ids
+            start = time.perf_counter()
+            outputs = model.generate(input_ids, **generate_kwargs)
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+            tokens += outputs.shape[1] - 1
+            generated_answers.append(tokenizer.decode(outputs[0], skip_special_tokens=True))
+        bleu, rouge = evaluate_model(generated_answers, eval_data)
+        report.append({
+            'mode': mode,
+            'mean_latency_ms': np.mean(latencies_ms),
+            'p95_latency_ms': np.percentile(latencies_ms, 95),
+            'tokens_per_sec': tokens / (sum(latencies_ms) / 1000),
+            'bleu': bleu,
+            'rouge1': rouge['rouge1']['fmeasure'],
+            'rougeL': rouge['rougeL']['fmeasure'],
+        })
+    return pd.DataFrame(report)
+
+eval_data = [{'question': row['cleaned_question'], 'answer': row['full_answer_text']} for _, row in eval_df.iterrows() if row['full_answer_text']][:200]
+print(benchmark_decoding_modes(model, tokenizer, eval_data))
+
+"""**Int8 quantized CPU inference**"""
+
+# Dynamic int8 quantization: the weights of every nn.Linear are converted to int8 once and activations
+# are quantized on the fly, which needs no calibration data. Works for the T5 generator and for the
+# MiniLM encoder (a SentenceTransformer is an nn.Module too).
+def quantize_int8(module, inplace=False):
+    return torch.quantization.quantize_dynamic(module.eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=inplace)
+
+# A quantized model is saved as its state dict; loading quantizes a freshly built fp32 model of the same
+# architecture and then overwrites it with the saved int8 weights
+def save_quantized(module, path):
+    torch.save(module.state_dict(), path)
+
+def load_quantized(fp32_module, path):
+    module = quantize_int8(fp32_module, inplace=True)
+    module.load_state_dict(torch.load(path, weights_only=False))
+    return module
+
+# Model name or path as a file name, so artifacts of different models never overwrite each other. A local
+# checkpoint directory also gets a fingerprint of its files, so retraining it in place gives new artifacts.
+def model_artifact_name(model_name):
+    name = re.sub(r'[^\w.-]', '_', model_name)
+    if os.path.isdir(model_name):
+        files = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in os.scandir(model_name) if entry.is_file())
+        name += '_' + hashlib.blake2b(repr(files).encode('utf-8'), digest_size=4).hexdigest()
+    return name
+
+# Load the generator and the encoder for serving, as fp32 or int8. The int8 artifacts are written on
+# the first int8 start and loaded on every later one (one file per model name).
+def load_inference_models(int8=False, t5_name='t5-small', encoder_name='all-MiniLM-L6-v2', quantized_dir='quantized_models'):
+    generator = T5ForConditionalGeneration.from_pretrained(t5_name).eval()
+    encoder = SentenceTransformer(encoder_name, device='cpu')
+    if not int8:
+        return generator, encoder
+    os.makedirs(quantized_dir, exist_ok=True)
+    quantized = []
+    for name, module in [(t5_name, generator), (encoder_name, encoder)]:
+        path = os.path.join(quantized_dir, model_artifact_name(name) + '_int8.pt')
+        if os.path.exists(path):
+            module = load_quantized(module, path)
+        else:
+            module = quantize_int8(module, inplace=True)
+            save_quantized(module, path)
+        quantized.append(module)
+    return tuple(quantized)
+
+# Size of a model's weights as serialized, in MB
+def model_size_mb(module):
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+# Compare fp32 and int8 end to end. Retrieval recall@k is measured against the fp32 encoder's own top k
+# over an fp32 corpus index; generation quality is BLEU/ROUGE from evaluate_model on the eval split.
+def quantization_report(models, tokenizer, eval_data, corpus_texts, k=10, generate_kwargs=DECODING_MODES['greedy']):
+    fp32_encoder = models['fp32'][1]
+    corpus_index = faiss.IndexFlatIP(fp32_encoder.get_sentence_embedding_dimension())
+    corpus_index.add(np.asarray(fp32_encoder.encode(list(corpus_texts), normalize_embeddings=True), dtype='float32'))
+    questions = [item['question'] for item in eval_data]
+    report, reference_ids = [], None
+    for name, (generator, encoder) in models.items():
+        start = time.perf_counter()
+        query_embeddings = np.asarray(encoder.encode(questions, batch_size=1, normalize_embeddings=True), dtype='float32')
+        encode_ms = (time.perf_counter() - start) * 1000 / len(questions)
+        _, ids = corpus_index.search(query_embeddings, k)
+        reference_ids = ids if reference_ids is None else reference_ids
+        recall = np.mean([len(set(row) & set(reference)) / k for row, reference in zip(ids, reference_ids)])
+
+        generated_answers = []
+        start = time.perf_counter()
+        for question in questions:
+            input_ids = tokenizer(f"question: {question}", return_tensors='pt', max_length=512, truncation=True).input_ids
+            generated_answers.append(tokenizer.decode(generator.generate(input_ids, **generate_kwargs)[0], skip_special_tokens=True))
+        generate_ms = (time.perf_counter() - start) * 1000 / len(questions)
+        bleu, rouge = evaluate_model(generated_answers, eval_data)
+        report.append({
+            'model': name,
+            f'recall@{k}': recall,
+            'bleu': bleu,
+            'rougeL': rouge['rougeL']['fmeasure'],
+            'encode_ms': encode_ms,
+            'generate_ms': generate_ms,
+            'generator_mb': model_size_mb(generator),
+            'encoder_mb': model_size_mb(encoder),
+        })
+    return pd.DataFrame(report).set_index('model')
+
+quantization_models = {'fp32': load_inference_models(int8=False), 'int8': load_inference_models(int8=True)}
+print(quantization_report(quantization_models, tokenizer, eval_data, df['cleaned_question']))
+
+"""**ONNX Runtime inference backend**"""
+
+!pip install optimum[onnxruntime]
+
+import onnxruntime
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTModelForSeq2SeqLM
+from transformers import AutoTokenizer
+
+# Export step: write the MiniLM encoder and the T5 encoder/decoder to ONNX, each into a directory named
+# after the model (see onnx_model_dirs). The T5 export includes a decoder that takes past key/values,
+# so each generation step only runs the newest token.
+def export_onnx_models(out_dir='onnx_models', t5_name='t5-small', encoder_name='sentence-transformers/all-MiniLM-L6-v2'):
+    generator_dir, encoder_dir = onnx_model_dirs(out_dir, t5_name, encoder_name)
+    if not os.path.exists(encoder_dir):
+        ORTModelForFeatureExtraction.from_pretrained(encoder_name, export=True).save_pretrained(encoder_dir)
+        AutoTokenizer.from_pretrained(encoder_name).save_pretrained(encoder_dir)
+    if not os.path.exists(generator_dir):
+        ORTModelForSeq2SeqLM.from_pretrained(t5_name, export=True, use_cache=True).save_pretrained(generator_dir)
+
+# Export directories of the generator and the encoder
+def onnx_model_dirs(out_dir, t5_name, encoder_name):
+    return os.path.join(out_dir, model_artifact_name(t5_name)), os.path.join(out_dir, model_artifact_name(encoder_name))
+
+def onnx_session_options(num_threads):
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    options.inter_op_num_threads = 1
+    return options
+
+# Drop-in for SentenceTransformer.encode over the exported MiniLM: mean pooling over the token embeddings
+# and L2 normalization, as in the all-MiniLM-L6-v2 pipeline (whose last module always normalizes, so
+# normalize_embeddings changes nothing here either)
+class OnnxSentenceEncoder:
+    def __init__(self, model_dir, num_threads=4, max_seq_length=256):
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, session_options=onnx_session_options(num_threads), provider='CPUExecutionProvider')
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = max_seq_length
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.config.hidden_size
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, convert_to_tensor=False, show_progress_bar=False, **kwargs):
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        embeddings = np.empty((len(sentences), self.get_sentence_embedding_dimension()), dtype='float32')
+        for start in range(0, len(sentences), batch_size):
+            batch = self.tokenizer(sentences[start:start + batch_size], padding=True, truncation=True, max_length=self.max_seq_length, return_tensors='np')
+            token_embeddings = self.model(**batch).last_hidden_state
+            mask = batch['attention_mask'][..., None].astype('float32')
+            pooled = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            embeddings[start:start + len(pooled)] = pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+# Load the ONNX generator and encoder (exporting them first if needed), each session on `num_threads`
+# CPU threads. The generator keeps the transformers generate() API, so it replaces the PyTorch model as is.
+def load_onnx_models(out_dir='onnx_models', num_threads=4, t5_name='t5-small', encoder_name='sentence-transformers/all-MiniLM-L6-v2'):
+    generator_dir, encoder_dir = onnx_model_dirs(out_dir, t5_name, encoder_name)
+    if not (os.path.exists(generator_dir) and os.path.exists(encoder_dir)):
+        export_onnx_models(out_dir, t5_name, encoder_name)
+    generator = ORTModelForSeq2SeqLM.from_pretrained(generator_dir, use_cache=True, session_options=onnx_session_options(num_threads), provider='CPUExecutionProvider')
+    return generator, OnnxSentenceEncoder(encoder_dir, num_threads)
+
+# Side-by-side check of inference backends on short queries, one query at a time as the service sees them:
+# per-query latency, the largest embedding difference and the share of identical answers (greedy decoding)
+# relative to the first backend
+def compare_backends(backends, tokenizer, questions, generate_kwargs=DECODING_MODES['greedy']):
+    report, reference = [], None
+    for name, (generator, encoder) in backends.items():
+        start = time.perf_counter()
+        embeddings = np.stack([np.asarray(encoder.encode([question], normalize_embeddings=True)[0], dtype='float32') for question in questions])
+        encode_ms = (time.perf_counter() - start) * 1000 / len(questions)
+
+        answers = []
+        start = time.perf_counter()
+        for question in questions:
+            input_ids = tokenizer(f"question: {question}", return_tensors='pt', max_length=512, truncation=True).input_ids
+            answers.append(tokenizer.decode(generator.generate(input_ids, **generate_kwargs)[0], skip_special_tokens=True))
+        generate_ms = (time.perf_counter() - start) * 1000 / len(questions)
+
+        reference = reference or (embeddings, answers)
+        report.append({
+            'backend': name,
+            'encode_ms': encode_ms,
+            'generate_ms': generate_ms,
+            'max_embedding_diff': float(np.abs(embeddings - reference[0]).max()),
+            'same_answers': np.mean([answer == expected for answer, expected in zip(answers, reference[1])]),
+        })
+    return pd.DataFrame(report).set_index('backend')
+
+# Both backends run the model the service is configured with (model_name), not just base t5-small
+onnx_backends = {'torch': load_inference_models(t5_name=model_name), 'onnx': load_onnx_models(num_threads=4, t5_name=model_name)}
+print(compare_backends(onnx_backends, tokenizer, [item['question'] for item in eval_data[:50]]))
+
 
 
 """**6**. **USER Interface Development**"""
@@ -964,28 +2425,154 @@ import json
 
 app = Flask(__name__)
 
-# Placeholder functions for your model and retrieval (implement these)
-def retrieve_passages(query):
-    # Implement your retrieval logic here
-    return ["Sample passage related to: " + query]
-
-def generate_answer(query, retrieved_passages):
-    # Implement your answer generation logic here
-    return "Generated answer based on: " + ', '.join(retrieved_passages)
-
-@app.route('/')
-def index():
+# int8 CPU inference: start with MEDQA_INT8=1 to serve the quantized generator (model_name) and encoder
+# (see quantization_report for the accuracy, latency and memory comparison with fp32)
+if os.environ.get('MEDQA_INT8') == '1':
+    model, sentence_model = load_inference_models(int8=True, t5_name=model_name)
+
+# ONNX Runtime inference: start with MEDQA_BACKEND=onnx (MEDQA_ONNX_THREADS sets the threads per session)
+if os.environ.get('MEDQA_BACKEND') == 'onnx':
+    model, sentence_model = load_onnx_models(num_threads=int(os.environ.get('MEDQA_ONNX_THREADS', 4)), t5_name=model_name)
+
+# Concurrent /ask requests are answered together by the batched RAG pipeline
+# (batch_generate: one embedding pass, one FAISS search and one model.generate call per batch).
+# Generation runs on ASK_NUM_WORKERS threads with at most ASK_MAX_PENDING queued requests; beyond that
+# /ask answers 429, so a long model.generate never blocks the request threads or cheap endpoints like /health.
+# With MEDQA_FID=1 the batches are answered in FiD mode from cached passage encoder states (fid_batch_generate).
+# The cached states must come from the serving model, so the backend is part of the cache key.
+ASK_MAX_BATCH_SIZE, ASK_NUM_WORKERS, ASK_MAX_PENDING = 8, 2, 32
+if os.environ.get('MEDQA_FID') == '1':
+    serving_backend = 'onnx' if os.environ.get('MEDQA_BACKEND') == 'onnx' else 'int8' if os.environ.get('MEDQA_INT8') == '1' else 'fp32'
+    encoder_state_cache = EncoderStateCache(model, tokenizer, f"{model_name}:{serving_backend}", cache_dir="t5_passage_states")
+ask_generate = fid_batch_generate if os.environ.get('MEDQA_FID') == '1' else batch_generate
+
+# Decoding policy of the model that actually serves (calibrated after the backend swap above) on
+# inputs shaped like the served ones. /ask requests may send a latency target in ms ("latency_ms");
+# without one they are decoded greedily, as the pipeline did before decoding modes existed.
+calibration_queries = ["What is the treatment for diabetes?", "What are the symptoms of asthma in children?"]
+decoding_policy = DecodingPolicy(default_mode='greedy').calibrate(model, tokenizer, [prepare_input(query, passages) for query, passages in zip(calibration_queries, retrieve_context(calibration_queries))])
+
+# A batch of (query, latency target) items: requests with the same target share one generate call
+def answer_ask_batch(items):
+    answers = [None] * len(items)
+    groups = {}
+    for position, (_, latency_ms) in enumerate(items):
+        groups.setdefault(latency_ms, []).append(position)
+    for latency_ms, positions in groups.items():
+        for position, answer in zip(positions, ask_generate([items[position][0] for position in positions], latency_ms=latency_ms)):
+            answers[position] = answer
+    return answers
+
+ask_batcher = MicroBatcher(answer_ask_batch, max_batch_size=ASK_MAX_BATCH_SIZE, max_wait_ms=20, num_workers=ASK_NUM_WORKERS, max_pending=ASK_MAX_PENDING)
+
+# Repeated questions are answered from the cache without touching the batcher or the models
+answer_cache = AnswerCache(sentence_model, max_size=10000, ttl=3600, similarity_threshold=0.95)
+
+# Named `home` so the view does not shadow the FAISS `index` used by batch_generate
+@app.route('/', endpoint='index')
+def home():
     return render_template('index.html')
 
+@app.route('/health')
+def health():
+    return jsonify({"status": "ok", "pending": ask_batcher.pending(), "cache": answer_cache.metrics()})
+
 @app.route('/ask', methods=['POST'])
 def ask():
     user_query = request.json.get('query')
-    retrieved_passages = retrieve_passages(user_query)
-    generated_answer = generate_answer(user_query, retrieved_passages)
+    if not user_query:
+        return jsonify({"error": "No query provided"}), 400  # Keep bad input out of the shared batch
+    latency_ms = request.json.get('latency_ms')
+    if latency_ms is not None and (isinstance(latency_ms, bool) or not isinstance(latency_ms, (int, float)) or latency_ms <= 0):
+        return jsonify({"error": "latency_ms must be a positive number"}), 400
+    generated_answer, cache_key, query_embedding = answer_cache.lookup(user_query)
+    if generated_answer is None:
+        try:
+            future = ask_batcher.submit((user_query, latency_ms))
+        except queue.Full:
+            return jsonify({"error": "Server is busy, please retry"}), 429, {"Retry-After": "1"}
+        generated_answer = future.result()
+        answer_cache.store(cache_key, query_embedding, generated_answer)
     return jsonify({"answer": generated_answer})
 
+from flask import Response
+from transformers import TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+
+# Stops model.generate before its next decoding step once `event` is set
+class StopOnEvent(StoppingCriteria):
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+# Streams each take their own generation thread (outside ask_batcher), so only a few may run at once
+STREAM_SLOTS = 4
+stream_slots = threading.BoundedSemaphore(STREAM_SLOTS)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Server-sent events: the retrieved passages are sent as soon as retrieval is done, then the answer
+# token by token as T5 decodes it (greedy decoding: streaming works one sequence at a time), then
+# `done` with the full answer. When the client disconnects, the server closes the response and the
+# stopping criterion ends generation at the next decoding step.
+@app.route('/ask/stream', methods=['POST'])
+def ask_stream():
+    user_query = request.json.get('query')
+    if not user_query:
+        return jsonify({"error": "No query provided"}), 400
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({"error": "Server is busy, please retry"}), 429, {"Retry-After": "1"}
+    stop = threading.Event()
+
+    def events():
+        passages = retrieve_context([user_query])[0]
+        yield sse_event('passages', passages)
+
+        inputs = tokenizer(prepare_input(user_query, passages), return_tensors='pt', max_length=512, truncation=True)
+        streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+
+        def run():
+            try:
+                model.generate(**inputs, **DECODING_MODES['greedy'], streamer=streamer, stopping_criteria=StoppingCriteriaList([StopOnEvent(stop)]))
+            except Exception:
+                streamer.end()  # Unblock the response loop below
+                raise
+
+        threading.Thread(target=run, daemon=True).start()
+        answer = []
+        for text in streamer:
+            if text:
+                answer.append(text)
+                yield sse_event('token', text)
+        yield sse_event('done', {"answer": ''.join(answer)})
+
+    response = Response(events(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    # Runs when the response finishes or the client goes away, even before the first event
+    def close():
+        stop.set()
+        stream_slots.release()
+
+    response.call_on_close(close)
+    return response
+
+!pip install waitress
+
+# Production serving: a threaded WSGI server instead of the single-process dev server.
+# Every request gets its own server thread, so /health and other cheap requests never queue behind an
+# /ask waiting on its future or an /ask/stream holding its connection; inference stays on ask_batcher's
+# workers. Every queued /ask, every /ask in a running batch and every open stream can hold a thread,
+# so the pool covers all of them plus headroom for the cheap endpoints.
+SERVER_THREADS = ASK_MAX_PENDING + ASK_NUM_WORKERS * ASK_MAX_BATCH_SIZE + STREAM_SLOTS + 8
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    if os.environ.get('MEDQA_DEV_SERVER') == '1':
+        app.run(debug=True, threaded=True)
+    else:
+        from waitress import serve
+        serve(app, host='0.0.0.0', port=5000, threads=SERVER_THREADS)
 
 !python app.py
 